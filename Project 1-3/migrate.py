@@ -0,0 +1,64 @@
+# python 3.9.6
+# berkeley-db 5.3.28
+# pip berkeleydb 18.1.5
+# Convert ./DB/*.db files written in the old "*"-joined text format into the binary row format of run.py
+from berkeleydb import db
+import pickle
+import os
+
+from run import ROW_FORMAT, date_to_ordinal, TableSchema
+
+# "*"-joined text row -> typed value list
+def parse_text_row(kinds, text):
+    values = []
+    for kind, value in zip(kinds, text.split("*")):
+        if value == "null":
+            values.append(None)
+        elif kind == "int":
+            values.append(int(value))
+        elif kind == "date":
+            values.append(date_to_ordinal(value))
+        else:
+            values.append(value)
+    return values
+
+def migrate_table(table_name, table_info):
+    schema = TableSchema(table_name, table_info)
+    path = './DB/' + table_name + '.db'
+    new_path = path + '.migrating'
+
+    oldDB = db.DB()
+    oldDB.open(path, dbtype=db.DB_HASH)
+    newDB = db.DB()
+    newDB.open(new_path, dbtype=db.DB_HASH, flags=db.DB_CREATE)
+    row_num = 0
+    for value in oldDB.values():
+        # rows are re-keyed from their primary key columns
+        val_list = parse_text_row(schema.kinds, value.decode())
+        newDB.put(schema.key(val_list), schema.codec.encode(val_list))
+        row_num += 1
+    oldDB.close()
+    newDB.close()
+    os.replace(new_path, path)
+    return row_num
+
+def main():
+    catalogDB = db.DB()
+    catalogDB.open("./DB/catalog.db", dbtype=db.DB_HASH)
+    if catalogDB.get(b"row_format") == ROW_FORMAT:
+        print("Tables are already stored in the current row format")
+        catalogDB.close()
+        return
+
+    tables = pickle.loads(catalogDB.get(b"tables"))
+    for table_name in tables:
+        table_info = pickle.loads(catalogDB.get(table_name.encode()))
+        row_num = migrate_table(table_name, table_info)
+        print("'" + table_name + "' table is migrated (" + str(row_num) + " row(s))")
+
+    catalogDB.put(b"row_format", ROW_FORMAT)
+    catalogDB.close()
+
+
+if __name__ == "__main__":
+    main()
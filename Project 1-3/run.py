@@ -6,9 +6,951 @@ from berkeleydb import db
 import pickle
 import os
 import datetime
+import struct
+import tempfile
+import operator
+import heapq
+import csv
+import time
+import hashlib
+import json
+import sys
+from collections import OrderedDict
 
 MY_PROMPT = "DB_2017-16140> "
-catalogDB = db.DB()
+# version of the on-disk row format, stored in catalogDB under b"row_format"
+ROW_FORMAT = b"2"
+# maximum number of table files kept open between statements
+MAX_OPEN_TABLES = 64
+# number of rows a join input or output keeps in memory before spilling to a temporary file
+JOIN_BUFFER_ROWS = int(os.environ.get("JOIN_BUFFER_ROWS", 100000))
+# number of rows LOAD DATA checks together before writing them
+LOAD_BATCH_ROWS = 1000
+# largest number of deleted keys checked one by one in a foreign key index, more are matched
+# in one pass over the index
+RI_PROBE_KEYS = 1000
+# locks and locked objects of the environment, a statement locks the pages it changes until
+# its transaction is finished while pages it only reads are unlocked once they are read
+LOCK_LIMIT = 100000
+# number of rows DELETE and UPDATE scan or change between commits outside BEGIN ... COMMIT
+DML_BATCH_ROWS = 1000
+# size in megabytes of the buffer pool shared by every file of the environment
+CACHE_SIZE_MB = int(os.environ.get("CACHE_SIZE_MB", 64))
+# page sizes accepted by CREATE TABLE ... PAGESIZE
+MIN_PAGE_SIZE = 512
+MAX_PAGE_SIZE = 65536
+# sizing of primary key Bloom filters, about 1% false positives at BLOOM_COUNTERS_PER_KEY
+BLOOM_COUNTERS_PER_KEY = 10
+BLOOM_MIN_COUNTERS = 1024
+BLOOM_HASH_NUM = 7
+# rows used to size the columns of the aligned output mode when no number is given
+ALIGNED_SAMPLE_ROWS = 100
+# number of groups a hash aggregation keeps in memory, rows of other groups are spilled
+# into AGGREGATE_PARTITIONS temporary files
+AGGREGATE_GROUPS = int(os.environ.get("AGGREGATE_GROUPS", 100000))
+AGGREGATE_PARTITIONS = 16
+# number of rows ORDER BY sorts in memory, longer inputs are sorted in runs written to
+# temporary files and merged; ORDER BY with a LIMIT up to this size keeps only a heap
+SORT_BUFFER_ROWS = int(os.environ.get("SORT_BUFFER_ROWS", 100000))
+# number of runs merged at once, more runs are merged in several passes
+SORT_MERGE_WAYS = 64
+# transactional environment holding the catalog, table and index files under ./DB
+# catalogDB is opened in it by open_environment()
+dbenv = db.DBEnv()
+catalogDB = None
+
+INT_FORMAT = struct.Struct(">q")
+DATE_FORMAT = struct.Struct(">i")
+CHAR_LEN_FORMAT = struct.Struct(">H")
+# largest values the row and key formats can hold
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+CHAR_MAX_BYTES = 65535
+KEY_INT_FORMAT = struct.Struct(">Q")
+KEY_DATE_FORMAT = struct.Struct(">I")
+
+def column_kind(col_type):
+    # "int", "date", "char(10)" -> "int", "date", "char"
+    return "char" if col_type.startswith("char") else col_type
+
+def date_to_ordinal(text):
+    return datetime.date.fromisoformat(text).toordinal()
+
+def value_to_text(kind, value):
+    if value is None:
+        return "null"
+    if kind == "date":
+        return datetime.date.fromordinal(value).isoformat()
+    return str(value)
+
+# Fit a parsed value into its column, raises ValueError if the row format cannot hold it
+# ints must fit in 8 bytes, chars are cut to the column length and must fit the 2-byte length
+def column_value(kind, value, max_len=None):
+    if kind == "int":
+        if value < INT_MIN or value > INT_MAX:
+            raise ValueError("int out of range")
+    elif kind == "char":
+        value = value[:max_len]
+        if len(value.encode()) > CHAR_MAX_BYTES:
+            raise ValueError("char too long")
+    return value
+
+# Parse a field of a loaded file into the stored form of a column kind, raises ValueError
+# strings are stored in lower case, as INSERT and UPDATE store them
+def text_to_value(kind, text, max_len=None):
+    text = text.strip()
+    if kind == "int":
+        return column_value(kind, int(text))
+    if kind == "date":
+        return date_to_ordinal(text)
+    return column_value(kind, text.lower(), max_len)
+
+class RowCodec():
+    # Binary row layout
+    #   null bitmap : 1 bit per column, ceil(n / 8) bytes
+    #   values      : non-null values in column order
+    #     int  -> 8-byte signed big-endian
+    #     date -> 4-byte signed big-endian day ordinal
+    #     char -> 2-byte length + utf-8 bytes
+    def __init__(self, types):
+        self.kinds = [column_kind(col_type) for col_type in types]
+        self.bitmap_size = (len(self.kinds) + 7) // 8
+
+    def encode(self, values):
+        bitmap = bytearray(self.bitmap_size)
+        body = []
+        for i in range(len(self.kinds)):
+            value = values[i]
+            kind = self.kinds[i]
+            if value is None:
+                bitmap[i >> 3] |= 1 << (i & 7)
+            elif kind == "int":
+                body.append(INT_FORMAT.pack(value))
+            elif kind == "date":
+                body.append(DATE_FORMAT.pack(value))
+            else:
+                data = value.encode()
+                body.append(CHAR_LEN_FORMAT.pack(len(data)))
+                body.append(data)
+        return bytes(bitmap) + b"".join(body)
+
+    def decode(self, data):
+        values = []
+        offset = self.bitmap_size
+        for i in range(len(self.kinds)):
+            if data[i >> 3] & (1 << (i & 7)):
+                values.append(None)
+                continue
+            kind = self.kinds[i]
+            if kind == "int":
+                values.append(INT_FORMAT.unpack_from(data, offset)[0])
+                offset += 8
+            elif kind == "date":
+                values.append(DATE_FORMAT.unpack_from(data, offset)[0])
+                offset += 4
+            else:
+                length = CHAR_LEN_FORMAT.unpack_from(data, offset)[0]
+                offset += 2
+                values.append(data[offset:offset + length].decode())
+                offset += length
+        return values
+
+# Order-preserving composite key: every field is a tag byte (0 = null, 1 = value) followed by
+#   int  -> 8-byte big-endian with the sign bit flipped
+#   date -> 4-byte big-endian day ordinal
+#   char -> utf-8 bytes with 0x00 escaped as 0x00 0xff, terminated by 0x00 0x00
+def encode_key(kinds, values):
+    parts = []
+    for kind, value in zip(kinds, values):
+        if value is None:
+            parts.append(b"\x00")
+        elif kind == "int":
+            parts.append(b"\x01" + KEY_INT_FORMAT.pack(value + (1 << 63)))
+        elif kind == "date":
+            parts.append(b"\x01" + KEY_DATE_FORMAT.pack(value))
+        else:
+            parts.append(b"\x01" + value.encode().replace(b"\x00", b"\x00\xff") + b"\x00\x00")
+    return b"".join(parts)
+
+class TableSchema():
+    # Decoded table descriptor with precomputed column and key positions
+    def __init__(self, name, table_info):
+        self.name = name
+        self.info = table_info
+        self.columns = table_info["columns"]
+        self.col_names = list(self.columns.keys())
+        self.col_index = {col_name: i for i, col_name in enumerate(self.col_names)}
+        self.kinds = [column_kind(col_info["type"]) for col_info in self.columns.values()]
+        self.codec = RowCodec([col_info["type"] for col_info in self.columns.values()])
+        self.pk_list = table_info["pk_list"]
+        self.pk_idx_list = [self.col_index[pk] for pk in self.pk_list]
+        self.pk_kinds = [self.kinds[idx] for idx in self.pk_idx_list]
+        self.referenced_by = table_info["referenced_by"]
+        # referenced table name -> {referenced column name: column index}
+        self.foreign_keys = {}
+        for col_name, col_info in self.columns.items():
+            if col_info["references"] is not None:
+                ref_table_name, ref_col_name = col_info["references"].split(".")
+                self.foreign_keys.setdefault(ref_table_name, {})[ref_col_name] = self.col_index[col_name]
+        # rows are kept in a HASH file unless the table was created with USING BTREE
+        self.organization = table_info.get("organization", "hash")
+        # the primary key seen as an index whose entries are the rows themselves
+        self.primary_index = IndexSchema(self, None, self.pk_list)
+        # primary keys are also kept in ./DB/<table>.bloom after CREATE BLOOM FILTER
+        self.bloom_filter = table_info.get("bloom_filter", False)
+        self.indexes = [IndexSchema(self, index_name, col_names) for index_name, col_names in table_info.get("indexes", {}).items()]
+        # filled by SchemaCache: {referenced table name: index on the foreign key columns}
+        # and [(referencing schema, its foreign key index, can_set_null)]
+        self.fk_indexes = {}
+        self.referencing = []
+
+    def key(self, values):
+        # build the storage key of a row from its full value list
+        return encode_key(self.pk_kinds, [values[idx] for idx in self.pk_idx_list])
+
+    def cols(self, alias=None):
+        # column list in the form used by where clause helpers
+        # [table name, table alias, column name, column alias, column kind]
+        return [[self.name, alias, col_name, None, kind] for col_name, kind in zip(self.col_names, self.kinds)]
+
+class IndexSchema():
+    # Secondary index stored in ./DB/<table>.<index>.idx as a BTREE with sorted duplicates
+    # mapping the order-preserving key of the indexed columns to primary keys of the table
+    # name is None for the primary key of a table, which is ordered only in a BTREE table
+    def __init__(self, table_schema, name, col_names):
+        self.name = name
+        self.table_name = table_schema.name
+        self.ordered = name is not None or table_schema.organization == "btree"
+        self.col_names = col_names
+        self.col_idx_list = [table_schema.col_index[col_name] for col_name in col_names]
+        self.kinds = [table_schema.kinds[idx] for idx in self.col_idx_list]
+
+    def key(self, values):
+        return encode_key(self.kinds, [values[idx] for idx in self.col_idx_list])
+
+class SchemaCache():
+    # Process-wide cache of table schemas
+    # catalogDB keeps a version counter under b"version" which is bumped by CREATE / DROP TABLE
+    # and CREATE / DROP INDEX,
+    # so other statements only compare the counter instead of unpickling the catalog
+    # The counter is read once per statement, checked is reset by expire() when a statement
+    # begins and by invalidate()
+    def __init__(self):
+        self.version = None
+        self.tables = []
+        self.schemas = None
+        self.checked = False
+
+    def refresh(self):
+        if self.checked and self.schemas is not None:
+            return
+        self.checked = True
+        version = catalogDB.get(b"version", txn=transactions.txn)
+        if self.schemas is not None and version == self.version:
+            return
+        self.tables = pickle.loads(catalogDB.get(b"tables", txn=transactions.txn))
+        self.schemas = {}
+        for table_name in self.tables:
+            self.schemas[table_name] = TableSchema(table_name, pickle.loads(catalogDB.get(table_name.encode(), txn=transactions.txn)))
+        # every foreign key gets an index named "fk.<referenced table>", ordered as the primary key
+        # of the referenced table, which cannot collide with the name of a user index
+        for schema in self.schemas.values():
+            for ref_table_name, fk_cols in schema.foreign_keys.items():
+                col_names = [schema.col_names[fk_cols[pk]] for pk in self.schemas[ref_table_name].pk_list]
+                fk_index = IndexSchema(schema, "fk." + ref_table_name, col_names)
+                schema.fk_indexes[ref_table_name] = fk_index
+                schema.indexes.append(fk_index)
+        for schema in self.schemas.values():
+            for ref_table_name in schema.referenced_by:
+                ref_schema = self.schemas[ref_table_name]
+                fk_index = ref_schema.fk_indexes[schema.name]
+                can_set_null = all(ref_schema.columns[col_name]["nullable"] for col_name in fk_index.col_names)
+                schema.referencing.append((ref_schema, fk_index, can_set_null))
+        self.version = version
+
+    def table_names(self):
+        self.refresh()
+        return self.tables
+
+    def get(self, table_name):
+        self.refresh()
+        return self.schemas.get(table_name)
+
+    def invalidate(self):
+        version = catalogDB.get(b"version", txn=transactions.txn)
+        version = 0 if version is None else int(version)
+        catalogDB.put(b"version", str(version + 1).encode(), txn=transactions.txn)
+        self.checked = False
+
+    def expire(self):
+        self.checked = False
+
+    # forget the schemas read inside an aborted transaction
+    def clear(self):
+        self.schemas = None
+
+schema_cache = SchemaCache()
+
+class HandlePool():
+    # Opened table handles keyed by table name, index handles keyed by "<table>.<index>"
+    # A statement may use more handles than the capacity, the least recently used ones are
+    # closed by release() once the statement is finished
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.handles = OrderedDict()
+
+    # file names are relative to the environment home ./DB
+    # the organization of a table is only looked up when its file has to be opened
+    def get(self, table_name):
+        handle = self.cached(table_name)
+        if handle is not None:
+            return handle
+        return self.open(table_name, table_name + '.db', table_dbtype(schema_cache.get(table_name).organization))
+
+    def get_index(self, table_name, index_name, create=False):
+        name = table_name + "." + index_name
+        return self.open(name, name + '.idx', db.DB_BTREE, db.DB_DUPSORT, db.DB_CREATE if create else 0)
+
+    def cached(self, name):
+        handle = self.handles.get(name)
+        if handle is not None:
+            self.handles.move_to_end(name)
+        return handle
+
+    # page_size only applies when the file is created
+    # A file is created in the transaction of the statement, so a rolled back statement leaves
+    # no file behind; abort_statement() closes the handles opened that way
+    def open(self, name, path, dbtype, db_flags=0, open_flags=0, page_size=None):
+        handle = self.cached(name)
+        if handle is not None:
+            return handle
+        handle = db.DB(dbenv)
+        if db_flags:
+            handle.set_flags(db_flags)
+        if page_size is not None:
+            handle.set_pagesize(page_size)
+        if open_flags & db.DB_CREATE:
+            handle.open(path, dbtype=dbtype, flags=open_flags, txn=transactions.txn)
+            transactions.created.append(name)
+        else:
+            # an existing file is opened in a transaction of its own
+            handle.open(path, dbtype=dbtype, flags=open_flags | db.DB_AUTO_COMMIT)
+        self.handles[name] = handle
+        return handle
+
+    def release(self):
+        while len(self.handles) > self.capacity:
+            table_name, handle = self.handles.popitem(last=False)
+            handle.close()
+
+    def close(self, name):
+        handle = self.handles.pop(name, None)
+        if handle is not None:
+            handle.close()
+
+    def close_all(self):
+        while len(self.handles) > 0:
+            table_name, handle = self.handles.popitem()
+            handle.close()
+
+table_pool = HandlePool(MAX_OPEN_TABLES)
+
+# Durability of a committed transaction: "sync" flushes the log to disk, "write_no_sync" writes
+# it to the operating system and "no_sync" leaves it in the log buffer
+COMMIT_FLAGS = {"sync": db.DB_TXN_SYNC, "write_no_sync": db.DB_TXN_WRITE_NOSYNC, "no_sync": db.DB_TXN_NOSYNC}
+# shown by SET DURABILITY
+DURABILITY_NOTES = {
+    "sync": "commits are flushed to disk before they are reported",
+    "write_no_sync": "commits are written to the operating system, a system crash can lose them",
+    "no_sync": "commits are kept in memory until the log buffer is written, a crash can lose them",
+}
+
+class TransactionManager():
+    # Every statement runs in a transaction kept in txn: a child of the transaction opened by
+    # BEGIN, or a transaction of its own which is committed when the statement is finished
+    # Messages telling that data was changed are kept in reports until the statement is committed
+    def __init__(self):
+        self.txn = None
+        self.user_txn = None
+        self.durability = "sync"
+        self.reports = []
+        # names of the handles in table_pool whose files were created by the statement
+        self.created = []
+
+    def report(self, message):
+        self.reports.append(message)
+
+    def begin_statement(self):
+        self.txn = dbenv.txn_begin(self.user_txn)
+        schema_cache.expire()
+
+    def end_statement(self):
+        txn, self.txn = self.txn, None
+        if txn is not None and self.user_txn is None:
+            self.commit(txn)
+        elif txn is not None:
+            txn.commit()
+        self.created = []
+        for message in self.reports:
+            print(MY_PROMPT + message)
+        self.reports = []
+
+    # cursors of the statement must be closed before its transaction is aborted
+    def abort_statement(self):
+        txn, self.txn = self.txn, None
+        self.reports = []
+        if txn is not None:
+            txn.abort()
+        # a handle of a file whose creation is rolled back can not be used any more
+        for name in self.created:
+            table_pool.close(name)
+        self.created = []
+        schema_cache.clear()
+        bloom_filters.discard_changes()
+
+    # LOAD DATA, DELETE and UPDATE outside of BEGIN ... COMMIT commit in batches, so a statement
+    # over a large table does not lock every page it changed until its end; the batches written
+    # before a failure are kept
+    def commit_batch(self):
+        if self.user_txn is None:
+            self.commit(self.txn)
+            self.txn = dbenv.txn_begin()
+
+    # Commit the batch of a scan and reopen its cursor in the next transaction on record, the
+    # next row to be read, which the batch did not change
+    def batch_cursor(self, handle, cursor, record):
+        if self.user_txn is not None:
+            return cursor
+        cursor.close()
+        self.commit_batch()
+        cursor = handle.cursor(txn=self.txn, flags=db.DB_READ_COMMITTED)
+        cursor.get_both(record[0], record[1])
+        return cursor
+
+    def begin(self):
+        self.user_txn = dbenv.txn_begin()
+
+    def commit(self, txn):
+        txn.commit(COMMIT_FLAGS[self.durability])
+
+    def rollback(self):
+        self.txn = None
+        txn, self.user_txn = self.user_txn, None
+        txn.abort()
+        schema_cache.clear()
+        bloom_filters.discard_changes()
+
+transactions = TransactionManager()
+
+# Open the environment, recovery brings its files back to the last committed transaction
+def open_environment():
+    global catalogDB
+    dbenv.set_lk_max_locks(LOCK_LIMIT)
+    dbenv.set_lk_max_objects(LOCK_LIMIT)
+    dbenv.set_cachesize(CACHE_SIZE_MB // 1024, CACHE_SIZE_MB % 1024 * 1024 * 1024, 1)
+    dbenv.log_set_config(db.DB_LOG_AUTO_REMOVE, 1)
+    dbenv.open("./DB", db.DB_CREATE | db.DB_INIT_LOCK | db.DB_INIT_LOG | db.DB_INIT_MPOOL | db.DB_INIT_TXN | db.DB_RECOVER)
+    catalogDB = db.DB(dbenv)
+
+def close_environment():
+    if transactions.user_txn is not None:
+        transactions.rollback()
+    bloom_filters.save_all()
+    table_pool.close_all()
+    catalogDB.close()
+    dbenv.txn_checkpoint()
+    dbenv.close()
+
+# Schema changes are committed on their own, so they are refused inside BEGIN ... COMMIT
+def schema_change_allowed():
+    if transactions.user_txn is not None:
+        print(MY_PROMPT + "Schema can not be changed inside a transaction")
+        return False
+    return True
+
+class BloomFilter():
+    # Counting Bloom filter over the primary keys of a table, so that a key which is surely
+    # absent is rejected without reading the table file
+    # File layout: clean flag (1 byte), number of hash functions (1 byte), number of counters
+    # (4 bytes), number of keys (4 bytes), then one byte per counter
+    # The clean flag is cleared on disk before the first change in memory, a filter found
+    # unclean at load time may miss keys and is rebuilt from the table
+    HEADER_FORMAT = struct.Struct(">BBII")
+
+    def __init__(self, path, size, hash_num=BLOOM_HASH_NUM):
+        self.path = path
+        self.hash_num = hash_num
+        self.counters = bytearray(size)
+        self.key_num = 0
+        self.dirty = False
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        size = len(self.counters)
+        return [(h1 + i * h2) % size for i in range(self.hash_num)]
+
+    def might_contain(self, key):
+        counters = self.counters
+        return all(counters[pos] != 0 for pos in self.positions(key))
+
+    def add(self, key):
+        self.mark_dirty()
+        counters = self.counters
+        for pos in self.positions(key):
+            # a saturated counter stays saturated, it may stand for more keys than it can count
+            if counters[pos] < 255:
+                counters[pos] += 1
+        self.key_num += 1
+
+    def remove(self, key):
+        self.mark_dirty()
+        counters = self.counters
+        for pos in self.positions(key):
+            if 0 < counters[pos] < 255:
+                counters[pos] -= 1
+        self.key_num -= 1
+
+    def overfull(self):
+        return self.key_num * BLOOM_COUNTERS_PER_KEY > 2 * len(self.counters)
+
+    def mark_dirty(self):
+        if self.dirty:
+            return
+        with open(self.path, "r+b") as file:
+            file.write(b"\x00")
+        self.dirty = True
+
+    def save(self):
+        with open(self.path + ".tmp", "wb") as file:
+            file.write(self.HEADER_FORMAT.pack(1, self.hash_num, len(self.counters), self.key_num))
+            file.write(self.counters)
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+def load_bloom_filter(path):
+    try:
+        with open(path, "rb") as file:
+            header = file.read(BloomFilter.HEADER_FORMAT.size)
+            clean, hash_num, size, key_num = BloomFilter.HEADER_FORMAT.unpack(header)
+            if not clean:
+                return None
+            bloom = BloomFilter(path, size, hash_num)
+            bloom.counters = bytearray(file.read())
+            bloom.key_num = key_num
+    except (OSError, struct.error):
+        return None
+    if len(bloom.counters) != size:
+        return None
+    return bloom
+
+# Make a Bloom filter holding every primary key of a table, sized for its number of rows
+def build_bloom_filter(schema):
+    keys = [key for key, value in scan_items(schema)]
+    size = max(BLOOM_MIN_COUNTERS, len(keys) * BLOOM_COUNTERS_PER_KEY)
+    bloom = BloomFilter('./DB/' + schema.name + '.bloom', size)
+    for key in keys:
+        for pos in bloom.positions(key):
+            if bloom.counters[pos] < 255:
+                bloom.counters[pos] += 1
+    bloom.key_num = len(keys)
+    # the keys may come from a transaction which is not committed yet, the filter is saved
+    # by save_all() once it is
+    bloom.dirty = True
+    return bloom
+
+class BloomFilterPool():
+    # Loaded Bloom filters keyed by table name, changed filters are written back by save_all()
+    # once the statements of an input line are finished
+    def __init__(self):
+        self.filters = {}
+
+    def get(self, schema):
+        if not schema.bloom_filter:
+            return None
+        bloom = self.filters.get(schema.name)
+        if bloom is None:
+            bloom = load_bloom_filter('./DB/' + schema.name + '.bloom')
+            if bloom is None:
+                bloom = build_bloom_filter(schema)
+            self.filters[schema.name] = bloom
+        return bloom
+
+    # filters are only saved outside of BEGIN ... COMMIT, a saved filter must not hold changes
+    # which may still be rolled back
+    def save_all(self):
+        if transactions.user_txn is not None:
+            return
+        for table_name, bloom in list(self.filters.items()):
+            schema = schema_cache.get(table_name)
+            if schema is None or not schema.bloom_filter:
+                del self.filters[table_name]
+            elif bloom.overfull():
+                self.filters[table_name] = build_bloom_filter(schema)
+                self.filters[table_name].save()
+            elif bloom.dirty:
+                bloom.save()
+
+    # forget the filters changed by an aborted transaction, their files are unclean or missing
+    # so they are rebuilt from the tables when they are used again
+    def discard_changes(self):
+        for table_name, bloom in list(self.filters.items()):
+            if bloom.dirty:
+                del self.filters[table_name]
+
+    def drop(self, table_name):
+        self.filters.pop(table_name, None)
+        if os.path.exists('./DB/' + table_name + '.bloom'):
+            os.remove('./DB/' + table_name + '.bloom')
+
+bloom_filters = BloomFilterPool()
+
+# Check if a primary key exists in a table, a Bloom filter answers surely absent keys
+def key_exists(schema, key):
+    bloom = bloom_filters.get(schema)
+    if bloom is not None and not bloom.might_contain(key):
+        return False
+    return table_pool.get(schema.name).exists(key, txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+
+def table_dbtype(organization):
+    return db.DB_BTREE if organization == "btree" else db.DB_HASH
+
+# {index name: table name} of every secondary index, catalogs made before indexes have none
+def load_index_map():
+    index_map = catalogDB.get(b"indexes", txn=transactions.txn)
+    if index_map is None:
+        return {}
+    return pickle.loads(index_map)
+
+# Write helpers keeping the secondary indexes of a table in sync with its rows
+def insert_row(schema, key, values):
+    table_pool.get(schema.name).put(key, schema.codec.encode(values), txn=transactions.txn)
+    bloom = bloom_filters.get(schema)
+    if bloom is not None:
+        bloom.add(key)
+    for index in schema.indexes:
+        table_pool.get_index(schema.name, index.name).put(index.key(values), key, txn=transactions.txn)
+
+# A cursor positioned on the row is used instead of looking the key up again
+def delete_row(schema, key, values, cursor=None):
+    if cursor is not None:
+        cursor.delete()
+    else:
+        table_pool.get(schema.name).delete(key, txn=transactions.txn)
+    bloom = bloom_filters.get(schema)
+    if bloom is not None:
+        bloom.remove(key)
+    for index in schema.indexes:
+        delete_index_entry(table_pool.get_index(schema.name, index.name), index.key(values), key)
+
+def update_row(schema, old_key, old_values, new_key, new_values, cursor=None):
+    targetDB = table_pool.get(schema.name)
+    if old_key != new_key:
+        targetDB.delete(old_key, txn=transactions.txn)
+        bloom = bloom_filters.get(schema)
+        if bloom is not None:
+            bloom.remove(old_key)
+            bloom.add(new_key)
+    if cursor is not None and old_key == new_key:
+        cursor.put(new_key, schema.codec.encode(new_values), db.DB_CURRENT)
+    else:
+        targetDB.put(new_key, schema.codec.encode(new_values), txn=transactions.txn)
+    for index in schema.indexes:
+        old_index_key = index.key(old_values)
+        new_index_key = index.key(new_values)
+        if old_key != new_key or old_index_key != new_index_key:
+            indexDB = table_pool.get_index(schema.name, index.name)
+            delete_index_entry(indexDB, old_index_key, old_key)
+            indexDB.put(new_index_key, new_key, txn=transactions.txn)
+
+def delete_index_entry(indexDB, index_key, key):
+    cursor = indexDB.cursor(txn=transactions.txn)
+    if cursor.get_both(index_key, key) is not None:
+        cursor.delete()
+    cursor.close()
+
+# Fill an index from the rows already stored in its table
+def build_index(schema, index):
+    indexDB = table_pool.get_index(schema.name, index.name, create=True)
+    for key, value in scan_items(schema):
+        indexDB.put(index.key(schema.codec.decode(value)), key, txn=transactions.txn)
+
+# Check if a row of the referencing table has the given primary key values as foreign key
+def has_referencing_row(fk_index, pk_values):
+    index_key = encode_key(fk_index.kinds, pk_values)
+    cursor = table_pool.get_index(fk_index.table_name, fk_index.name).cursor(txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+    record = cursor.set_range(index_key)
+    cursor.close()
+    return record is not None and record[0] == index_key
+
+# (foreign key, primary key) of the rows of the referencing table whose foreign key is one of keys,
+# the primary keys of the referenced table; a few keys are probed in the foreign key index,
+# otherwise the whole index is read once and matched against the set of keys
+def referencing_records(fk_index, keys):
+    if len(keys) <= RI_PROBE_KEYS:
+        for key in keys:
+            yield from IndexScan(fk_index, prefix=key).records()
+        return
+    for index_key, key in IndexScan(fk_index).records():
+        if index_key in keys:
+            yield index_key, key
+
+# Check the referencing tables once for all the rows a DELETE removes, given by their keys
+# Returns the keys which are still referenced and can not be deleted, and the referencing rows
+# to be set null as (position in schema.referencing, primary key)
+def check_referencing_rows(schema, keys):
+    blocked = set()
+    for ref_schema, fk_index, can_set_null in schema.referencing:
+        if not can_set_null:
+            for index_key, ref_key in referencing_records(fk_index, keys - blocked):
+                blocked.add(index_key)
+    deletable = keys - blocked
+    set_null_rows = RowBuffer()
+    for i in range(len(schema.referencing)):
+        ref_schema, fk_index, can_set_null = schema.referencing[i]
+        if can_set_null:
+            for index_key, ref_key in referencing_records(fk_index, deletable):
+                set_null_rows.append((i, ref_key))
+    return blocked, set_null_rows
+
+# Iterate (key, value) of the stored rows of a table with a cursor instead of loading them all
+# at once, or only the rows found through an index when an IndexScan is given
+# batched scans commit every DML_BATCH_ROWS rows, see TransactionManager.batch_cursor()
+def scan_items(schema, access=None, batched=False):
+    targetDB = table_pool.get(schema.name)
+    if access is not None and access.index.name is None:
+        yield from access.records(batched)
+        return
+    if access is not None:
+        for index_key, key in access.records(batched):
+            value = targetDB.get(key, txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+            if value is not None:
+                yield key, value
+        return
+    cursor = targetDB.cursor(txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+    try:
+        record = cursor.first()
+        while record is not None:
+            yield record
+            record = cursor.next()
+    finally:
+        cursor.close()
+
+# Iterate (cursor, key, value) of the rows to be changed by DELETE or UPDATE
+# A scan of the table gives its cursor so the current row is changed in place, rows found
+# through a secondary index are changed by key and the cursor is None
+# batched is only given when every row changed by the scan leaves the database consistent
+def scan_items_for_write(schema, access=None, batched=False):
+    if access is not None and access.index.name is None:
+        for cursor, record in access.cursor_records(batched):
+            yield cursor, record[0], record[1]
+        return
+    if access is not None:
+        for key, value in scan_items(schema, access, batched):
+            yield None, key, value
+        return
+    targetDB = table_pool.get(schema.name)
+    cursor = targetDB.cursor(txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+    try:
+        scanned = 0
+        record = cursor.first()
+        while record is not None:
+            yield cursor, record[0], record[1]
+            record = cursor.next()
+            scanned += 1
+            if batched and record is not None and scanned % DML_BATCH_ROWS == 0:
+                cursor = transactions.batch_cursor(targetDB, cursor, record)
+    finally:
+        cursor.close()
+
+class IndexScan():
+    # Range of an index: either the entries starting with an equality prefix or the entries
+    # whose first column lies between lower and upper, given as (encoded value, inclusive)
+    def __init__(self, index, prefix=None, lower=None, upper=None):
+        self.index = index
+        self.prefix = prefix
+        self.lower = lower
+        self.upper = upper
+
+    # yields (index key, primary key) of a secondary index and (primary key, row) of a table
+    def records(self, batched=False):
+        for cursor, record in self.cursor_records(batched):
+            yield record
+
+    # yields (cursor, record) with the cursor positioned on the record, None for a HASH table
+    def cursor_records(self, batched=False):
+        if self.index.name is None:
+            scannedDB = table_pool.get(self.index.table_name)
+            # a HASH table can only be searched by its whole primary key
+            if not self.index.ordered:
+                value = scannedDB.get(self.prefix, txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+                if value is not None:
+                    yield None, (self.prefix, value)
+                return
+        else:
+            scannedDB = table_pool.get_index(self.index.table_name, self.index.name)
+        cursor = scannedDB.cursor(txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+        if self.prefix is not None:
+            start = self.prefix
+        elif self.lower is not None:
+            start = self.lower[0]
+        else:
+            # skip null entries
+            start = b"\x01"
+        try:
+            scanned = 0
+            record = cursor.set_range(start)
+            while record is not None:
+                index_key = record[0]
+                if self.prefix is not None:
+                    if not index_key.startswith(self.prefix):
+                        break
+                else:
+                    if self.lower is not None and not self.lower[1] and index_key.startswith(self.lower[0]):
+                        record = cursor.next()
+                        continue
+                    if self.upper is not None and index_key >= self.upper[0]:
+                        if not (self.upper[1] and index_key.startswith(self.upper[0])):
+                            break
+                yield cursor, record
+                record = cursor.next()
+                scanned += 1
+                if batched and record is not None and scanned % DML_BATCH_ROWS == 0:
+                    cursor = transactions.batch_cursor(scannedDB, cursor, record)
+        finally:
+            cursor.close()
+
+FLIPPED_OPS = {"=": "=", "!=": "!=", "<": ">", ">": "<", "<=": ">=", ">=": "<="}
+
+# Choose the primary key or a secondary index for the conjuncts of a where clause on a single table
+# Equality on the leading index columns is preferred, otherwise a range on the first column
+def plan_index_scan(schema, cols, factors):
+    if factors is None:
+        return None
+    # collect "column op constant" conjuncts as (column index, op, value)
+    preds = []
+    for factor in factors:
+        node = factor.children[1].children[0]
+        if factor.children[0] is not None or node.data != "predicate":
+            continue
+        comp = node.children[0]
+        if comp.data != "comparison_predicate":
+            continue
+        left, right = comp.children[0], comp.children[2]
+        op = comp.children[1].value
+        if len(left.children) == 2 and len(right.children) == 1:
+            col_tree, const_tree = left, right
+        elif len(left.children) == 1 and len(right.children) == 2:
+            col_tree, const_tree = right, left
+            op = FLIPPED_OPS[op]
+        else:
+            continue
+        idx = resolve_operand(cols, col_tree.children[0], col_tree.children[1])
+        value = literal_value(cols[idx][4], const_tree.children[0].children[0])
+        # an int outside the key range cannot be encoded, the conjunct is left to the row filter
+        if value is None or (cols[idx][4] == "int" and not INT_MIN <= value <= INT_MAX):
+            continue
+        preds.append((idx, op, value))
+
+    # the primary key comes first, reading it needs no lookup of the rows
+    best = None
+    best_eq = 0
+    for index in [schema.primary_index] + schema.indexes:
+        eq_values = []
+        for col_idx in index.col_idx_list:
+            values = [value for idx, op, value in preds if idx == col_idx and op == "="]
+            if len(values) == 0:
+                break
+            eq_values.append(values[0])
+        if not index.ordered and len(eq_values) < len(index.col_idx_list):
+            continue
+        if len(eq_values) > best_eq:
+            best_eq = len(eq_values)
+            best = IndexScan(index, prefix=encode_key(index.kinds, eq_values))
+            continue
+        if best is not None:
+            continue
+        lower = upper = None
+        for idx, op, value in preds:
+            if idx != index.col_idx_list[0]:
+                continue
+            if op in (">", ">=") and (lower is None or value > lower[0] or (value == lower[0] and op == ">")):
+                lower = (value, op == ">=")
+            elif op in ("<", "<=") and (upper is None or value < upper[0] or (value == upper[0] and op == "<")):
+                upper = (value, op == "<=")
+        if lower is not None or upper is not None:
+            kinds = index.kinds[:1]
+            best = IndexScan(index,
+                lower=None if lower is None else (encode_key(kinds, [lower[0]]), lower[1]),
+                upper=None if upper is None else (encode_key(kinds, [upper[0]]), upper[1]))
+    return best
+
+# Convert a constant token of the where clause into the stored form of a column kind
+def literal_value(kind, token):
+    try:
+        if token.type == "INT" and kind == "int":
+            return int(token.value)
+        if token.type == "DATE" and kind == "date":
+            return date_to_ordinal(token.value)
+        if token.type == "STR" and kind == "char":
+            return token.value[1:-1]
+    except ValueError:
+        pass
+    return None
+
+class RowBuffer():
+    # Rows kept in memory up to JOIN_BUFFER_ROWS, later rows are spilled to a temporary file
+    # in pickled blocks; the buffer can be iterated any number of times
+    SPILL_BLOCK = 1000
+
+    def __init__(self, budget=None):
+        self.budget = JOIN_BUFFER_ROWS if budget is None else budget
+        self.rows = []
+        self.pending = []
+        self.spill = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def spilled(self):
+        return self.spill is not None
+
+    def append(self, row):
+        self.size += 1
+        if self.spill is None:
+            if len(self.rows) < self.budget:
+                self.rows.append(row)
+                return
+            self.spill = tempfile.TemporaryFile()
+        self.pending.append(row)
+        if len(self.pending) >= self.SPILL_BLOCK:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.spill.seek(0, os.SEEK_END)
+            pickle.dump(self.pending, self.spill)
+            self.pending = []
+
+    def __iter__(self):
+        yield from self.rows
+        if self.spill is None:
+            return
+        self.flush()
+        self.spill.seek(0)
+        while True:
+            try:
+                block = pickle.load(self.spill)
+            except EOFError:
+                break
+            yield from block
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
 
 class TreeParser():
     def parse(self, root):
@@ -108,15 +1050,27 @@ class T(Transformer):
     # items[1] == Token "TABLE"
     # items[2] == Tree "table_name"
     # items[3] == Tree "table_element_list"
+    # items[4] == Tree "table_organization"
+    # items[5] == Tree "table_page_size"
     def create_table_query(self, items):
+        if not schema_change_allowed():
+            return
         table_name = items[2].children[0].value.lower()
-        tables = pickle.loads(catalogDB.get(b"tables"))
+        tables = pickle.loads(catalogDB.get(b"tables", txn=transactions.txn))
         # check if table already exists
         if table_name in tables:
             raise Exception("TableExistenceError")
         tables.append(table_name)
         # parse query and create table schema dictionary
         table_dict = TreeParser().parse(items[3])
+        if items[4] is not None:
+            table_dict["organization"] = items[4].children[1].value.lower()
+        if items[5] is not None:
+            page_size = int(items[5].children[1].value)
+            # the file format only allows powers of two in this range
+            if page_size < MIN_PAGE_SIZE or page_size > MAX_PAGE_SIZE or page_size & (page_size - 1) != 0:
+                raise Exception("PageSizeError")
+            table_dict["page_size"] = page_size
         # check referential integrity
         referenced_table_dict = {}
         for col_name, col_info in table_dict["columns"].items():
@@ -125,7 +1079,7 @@ class T(Transformer):
                 if ref_table_name not in tables or ref_table_name == table_name:
                     raise Exception("ReferenceTableExistenceError")
                 if ref_table_name not in referenced_table_dict:
-                    referenced_table_dict[ref_table_name] = pickle.loads(catalogDB.get(ref_table_name.encode()))
+                    referenced_table_dict[ref_table_name] = pickle.loads(catalogDB.get(ref_table_name.encode(), txn=transactions.txn))
                     referenced_table_dict[ref_table_name]["referenced_number"] = 1
                 else:
                     referenced_table_dict[ref_table_name]["referenced_number"] += 1
@@ -141,63 +1095,190 @@ class T(Transformer):
                 raise Exception("ReferenceTypeError")
             del(ref_table_info["referenced_number"])
             ref_table_info["referenced_by"].append(table_name)
-            catalogDB.put(ref_name.encode(), pickle.dumps(ref_table_info))
-
-        catalogDB.put(b"tables", pickle.dumps(tables))
-        catalogDB.put(table_name.encode(), pickle.dumps(table_dict))
-        targetDB = db.DB()
-        targetDB.open('./DB/' + table_name + '.db', dbtype=db.DB_HASH, flags=db.DB_CREATE)
-
-        targetDB.close()
-        print(MY_PROMPT + "'"+table_name+"'" + " table is created")
+            catalogDB.put(ref_name.encode(), pickle.dumps(ref_table_info), txn=transactions.txn)
+
+        catalogDB.put(b"tables", pickle.dumps(tables), txn=transactions.txn)
+        catalogDB.put(table_name.encode(), pickle.dumps(table_dict), txn=transactions.txn)
+        schema_cache.invalidate()
+        # the file is created with the catalog entries, in the transaction of the statement
+        table_pool.open(table_name, table_name + '.db', table_dbtype(table_dict.get("organization")), open_flags=db.DB_CREATE | db.DB_EXCL,
+                        page_size=table_dict.get("page_size"))
+        # create empty indexes on the foreign keys
+        for fk_index in schema_cache.get(table_name).fk_indexes.values():
+            table_pool.get_index(table_name, fk_index.name, create=True)
+        transactions.report("'"+table_name+"'" + " table is created")
         
     # items[0] == Token "DROP"
     # items[1] == Token "TABLE"
     # items[2] == Tree "table_name"
     def drop_table_query(self, items):
+        if not schema_change_allowed():
+            return
         table_name = items[2].children[0].value
-        tables = pickle.loads(catalogDB.get(b"tables"))
+        target = schema_cache.get(table_name)
         # check if table exists
-        if table_name not in tables:
+        if target is None:
             print(MY_PROMPT + "No such table")
             return
-        target = pickle.loads(catalogDB.get(table_name.encode()))
         # check if table is referenced by other tables
-        if len(target["referenced_by"]) != 0:
+        if len(target.referenced_by) != 0:
             print(MY_PROMPT + "Drop table has failed: '" + table_name +"' is referenced by other table")
             return
-        target = pickle.loads(catalogDB.get(table_name.encode()))
-        referencing_tables = []
-        # check if table is referencing other tables
-        for column in target["columns"]:
-            if target["columns"][column]["references"] is not None:
-                ref_table_name, ref_col_name = target["columns"][column]["references"].split(".")
-                if ref_table_name not in referencing_tables:
-                    referencing_tables.append(ref_table_name)
-        for ref_table_name in referencing_tables:
-            ref_table_info = pickle.loads(catalogDB.get(ref_table_name.encode()))
+        # remove table from the tables it references
+        for ref_table_name in target.foreign_keys:
+            ref_table_info = pickle.loads(catalogDB.get(ref_table_name.encode(), txn=transactions.txn))
             ref_table_info["referenced_by"].remove(table_name)
-            catalogDB.put(ref_table_name.encode(), pickle.dumps(ref_table_info))
+            catalogDB.put(ref_table_name.encode(), pickle.dumps(ref_table_info), txn=transactions.txn)
         # update catalogDB
+        tables = pickle.loads(catalogDB.get(b"tables", txn=transactions.txn))
         tables.remove(table_name)
-        catalogDB.put(b"tables", pickle.dumps(tables))
-        catalogDB.delete(table_name.encode())
-        os.remove('./DB/' + table_name + '.db')
-        print(MY_PROMPT + "'" + table_name + "' table is dropped")
+        catalogDB.put(b"tables", pickle.dumps(tables), txn=transactions.txn)
+        catalogDB.delete(table_name.encode(), txn=transactions.txn)
+        # remove indexes of the table, including the ones on its foreign keys
+        index_map = load_index_map()
+        for index_name in target.info.get("indexes", {}):
+            del index_map[index_name]
+        catalogDB.put(b"indexes", pickle.dumps(index_map), txn=transactions.txn)
+        # files are removed by the transaction, an abort keeps them
+        for index in target.indexes:
+            table_pool.close(table_name + "." + index.name)
+            dbenv.dbremove(table_name + '.' + index.name + '.idx', txn=transactions.txn)
+        schema_cache.invalidate()
+        table_pool.close(table_name)
+        bloom_filters.drop(table_name)
+        dbenv.dbremove(table_name + '.db', txn=transactions.txn)
+        transactions.report("'" + table_name + "' table is dropped")
+
+    # items[0] == Token "CREATE"
+    # items[1] == Token "BLOOM"
+    # items[2] == Token "FILTER"
+    # items[3] == Token "ON"
+    # items[4] == Tree "table_name"
+    def create_bloom_filter_query(self, items):
+        if not schema_change_allowed():
+            return
+        table_name = items[4].children[0].value.lower()
+        schema = schema_cache.get(table_name)
+        # check if table exists
+        if schema is None:
+            print(MY_PROMPT + "No such table")
+            return
+        if schema.bloom_filter:
+            print(MY_PROMPT + "Create bloom filter has failed: '" + table_name + "' already has a bloom filter")
+            return
+        # update catalogDB
+        table_info = pickle.loads(catalogDB.get(table_name.encode(), txn=transactions.txn))
+        table_info["bloom_filter"] = True
+        catalogDB.put(table_name.encode(), pickle.dumps(table_info), txn=transactions.txn)
+        schema_cache.invalidate()
+        bloom_filters.get(schema_cache.get(table_name))
+        transactions.report("Bloom filter is created on '" + table_name + "'")
+
+    # items[0] == Token "DROP"
+    # items[1] == Token "BLOOM"
+    # items[2] == Token "FILTER"
+    # items[3] == Token "ON"
+    # items[4] == Tree "table_name"
+    def drop_bloom_filter_query(self, items):
+        if not schema_change_allowed():
+            return
+        table_name = items[4].children[0].value.lower()
+        schema = schema_cache.get(table_name)
+        # check if table exists
+        if schema is None:
+            print(MY_PROMPT + "No such table")
+            return
+        if not schema.bloom_filter:
+            print(MY_PROMPT + "No such bloom filter")
+            return
+        # update catalogDB
+        table_info = pickle.loads(catalogDB.get(table_name.encode(), txn=transactions.txn))
+        table_info["bloom_filter"] = False
+        catalogDB.put(table_name.encode(), pickle.dumps(table_info), txn=transactions.txn)
+        schema_cache.invalidate()
+        bloom_filters.drop(table_name)
+        transactions.report("Bloom filter is dropped from '" + table_name + "'")
+
+    # items[0] == Token "CREATE"
+    # items[1] == Token "INDEX"
+    # items[2] == Tree "index_name"
+    # items[3] == Token "ON"
+    # items[4] == Tree "table_name"
+    # items[5] == Tree "column_name_list"
+    def create_index_query(self, items):
+        if not schema_change_allowed():
+            return
+        index_name = items[2].children[0].value.lower()
+        table_name = items[4].children[0].value.lower()
+        schema = schema_cache.get(table_name)
+        # check if table exists
+        if schema is None:
+            print(MY_PROMPT + "No such table")
+            return
+        # check if index name is used
+        index_map = load_index_map()
+        if index_name in index_map:
+            print(MY_PROMPT + "Create index has failed: index with the same name already exists")
+            return
+        # check if columns exist
+        col_names = []
+        for colTree in items[5].children[1:-1]:
+            col_name = colTree.children[0].value.lower()
+            if col_name not in schema.col_index:
+                print(MY_PROMPT + "Create index has failed: '" + col_name + "' does not exist")
+                return
+            if col_name in col_names:
+                print(MY_PROMPT + "Create index has failed: column is duplicated")
+                return
+            col_names.append(col_name)
+
+        # build index from the rows of the table
+        build_index(schema, IndexSchema(schema, index_name, col_names))
+
+        # update catalogDB
+        table_info = pickle.loads(catalogDB.get(table_name.encode(), txn=transactions.txn))
+        table_info.setdefault("indexes", {})[index_name] = col_names
+        catalogDB.put(table_name.encode(), pickle.dumps(table_info), txn=transactions.txn)
+        index_map[index_name] = table_name
+        catalogDB.put(b"indexes", pickle.dumps(index_map), txn=transactions.txn)
+        schema_cache.invalidate()
+        transactions.report("'" + index_name + "' index is created")
+
+    # items[0] == Token "DROP"
+    # items[1] == Token "INDEX"
+    # items[2] == Tree "index_name"
+    def drop_index_query(self, items):
+        if not schema_change_allowed():
+            return
+        index_name = items[2].children[0].value.lower()
+        index_map = load_index_map()
+        # check if index exists
+        if index_name not in index_map:
+            print(MY_PROMPT + "No such index")
+            return
+        table_name = index_map.pop(index_name)
+        # update catalogDB
+        table_info = pickle.loads(catalogDB.get(table_name.encode(), txn=transactions.txn))
+        del table_info["indexes"][index_name]
+        catalogDB.put(table_name.encode(), pickle.dumps(table_info), txn=transactions.txn)
+        catalogDB.put(b"indexes", pickle.dumps(index_map), txn=transactions.txn)
+        schema_cache.invalidate()
+        table_pool.close(table_name + "." + index_name)
+        dbenv.dbremove(table_name + '.' + index_name + '.idx', txn=transactions.txn)
+        transactions.report("'" + index_name + "' index is dropped")
 
     def desc_query(self, items):
         table_name = items[1].children[0].value
-        tables = pickle.loads(catalogDB.get(b"tables"))
+        target = schema_cache.get(table_name)
         # check if table exists
-        if table_name not in tables:
+        if target is None:
             print(MY_PROMPT + "No such table")
             return
-        target = pickle.loads(catalogDB.get(table_name.encode()))
         # print table schema
         print("-------------------------------------------------")
         print("table name [" + table_name + "]")
         print(f"{'column name':21s}{'type':11s}{'null':11s}{'key':10s}")
-        for col_name, col_info in target["columns"].items():
+        for col_name, col_info in target.columns.items():
             nullable = "Y" if col_info["nullable"] else "N"
             key = "PRI" if col_info["primary_key"] else ""
             if col_info["references"] is not None:
@@ -206,17 +1287,40 @@ class T(Transformer):
         print("-------------------------------------------------")
 
     def show_tables_query(self, items):
-        tables = pickle.loads(catalogDB.get(b"tables"))
+        tables = schema_cache.table_names()
         print("----------------")
         for table in tables:
             print(table)
         print("----------------")
 
+    def show_cache_stats_query(self, items):
+        stats, file_stats = dbenv.memp_stat()
+        hits, misses = stats["cache_hit"], stats["cache_miss"]
+        hit_ratio = str(round(100 * hits / (hits + misses), 2)) + "%" if hits + misses > 0 else "-"
+        print("-------------------------------------------------")
+        print(f"{'cache size':21s}{stats['gbytes'] * 1024 ** 3 + stats['bytes']} bytes")
+        print(f"{'pages in cache':21s}{stats['pages']} ({stats['page_dirty']} dirty)")
+        print(f"{'hits':21s}{hits}")
+        print(f"{'misses':21s}{misses}")
+        print(f"{'hit ratio':21s}{hit_ratio}")
+        print(f"{'pages read':21s}{stats['page_in']}")
+        print(f"{'pages written':21s}{stats['page_out']}")
+        print(f"{'clean evictions':21s}{stats['ro_evict']}")
+        print(f"{'dirty evictions':21s}{stats['rw_evict']}")
+        # hits and misses of each file show which tables make up the working set
+        if len(file_stats) > 0:
+            print(f"{'file name':21s}{'hits':11s}{'misses':11s}{'page size':10s}")
+            for file_name, file_stat in sorted(file_stats.items()):
+                print(f"{file_name:20s} {file_stat['cache_hit']:<10d} {file_stat['cache_miss']:<10d} {file_stat['pagesize']:<10d}")
+        print("-------------------------------------------------")
+
     # items[0] == Token "SELECT"
     # items[1] == Tree "select_list"
     # items[2] == Tree "table_expression"
+    # items[3] == Tree "order_by_clause"
+    # items[4] == Tree "limit_clause"
     def select_query(self, items):
-        db_table_list = pickle.loads(catalogDB.get(b"tables"))
+        db_table_list = schema_cache.table_names()
         
         # parse from clause
         table_name_list = []
@@ -237,153 +1341,165 @@ class T(Transformer):
                 table_alias_list.append(None)
 
 
-        # parse select clause / not * case
-        column_name_list = []
-        column_alias_list = []
-        column_table_name_list = []
-        column_table_alias_list = []
-
-        select_list = items[1]
-        if len(select_list.children) > 0:
-            for selected_column in select_list.children:
-                table_name = table_name_list[0]
-                table_alias = None
-                col_name = selected_column.children[1].children[0].value
-                col_alias = None
-                # parse table name
-                if selected_column.children[0] is not None:
-                    name = selected_column.children[0].children[0].value
-                    if name in table_alias_list:
-                        table_alias = name
-                        table_name = table_name_list[table_alias_list.index(table_alias)]
-                    elif name in table_name_list:
-                        table_name = name
-                    else:
-                        print(MY_PROMPT + "No such table")
-                        return
-                # parse column alias
-                if selected_column.children[3] is not None:
-                    col_alias = selected_column.children[3].children[0].value
-                column_name_list.append(col_name)
-                column_alias_list.append(col_alias)
-                column_table_name_list.append(table_name)
-                column_table_alias_list.append(table_alias)
-
-
-        # join tables
-        joined_rows = [[]]
+        # make joined column list
+        # [table name, table alias, column name, column alias, kind]
         joined_cols = []
-        for table in table_name_list:
-            # make joined column list
-            column_list = pickle.loads(catalogDB.get(table.encode()))["columns"].keys()
-            column_list = list(column_list)
-            for column in column_list:
-                if column in column_alias_list: 
-                    col_alias = column_alias_list[column_name_list.index(column)]
-                else:
-                    col_alias =  None
-                joined_cols.append([table, table_alias_list[table_name_list.index(table)], column, col_alias])
-            
-            # make joined rows
-            targetDB = db.DB()
-            targetDB.open('./DB/' + table + '.db')
-            old_size = len(joined_rows)
-            for i in range(old_size):
-                old_row = joined_rows.pop(0)
-                for row in targetDB.values():
-                    new_row = old_row + row.decode().split("*")
-                    joined_rows.append(new_row)
-            targetDB.close()
-        
-
-        # select all columns when select *
+        for i in range(len(table_name_list)):
+            table = table_name_list[i]
+            schema = schema_cache.get(table)
+            for column, kind in zip(schema.col_names, schema.kinds):
+                joined_cols.append([table, table_alias_list[i], column, None, kind])
+
+        # resolve selected columns once, rows are projected by their positions in joined rows
+        # aggregate functions are planned with the group by clause
+        select_list = items[1]
+        positions = []
         if len(select_list.children) == 0:
-            for col in joined_cols:
-                column_name_list.append(col[2])
-                column_alias_list.append(col[3])
-                column_table_name_list.append(col[0])
-                column_table_alias_list.append(col[1])
-
+            positions = list(range(len(joined_cols)))
+        for selected_column in select_list.children:
+            if selected_column.data == "aggregate_column":
+                continue
+            idx = resolve_select_column(joined_cols, selected_column.children[0], selected_column.children[1])
+            if selected_column.children[3] is not None:
+                joined_cols[idx][3] = selected_column.children[3].children[0].value.lower()
+            positions.append(idx)
+
+        # compile where clause before reading any row
+        # conjuncts on a single table are applied while the table is scanned
+        widths = [len(schema_cache.get(table).col_names) for table in table_name_list]
+        table_filters = [None] * len(table_name_list)
+        table_factors = [None] * len(table_name_list)
+        where_test = None
+        join_preds = []
+        if items[2].children[1] is not None:
+            bool_expr = items[2].children[1].children[1]
+            table_filters, table_factors, where_test = push_down_predicates(joined_cols, widths, bool_expr)
+            join_preds = find_join_predicates(bool_expr, table_name_list, table_alias_list)
+
+        # plan group by, aggregate functions and having clause before reading any row
+        aggregation = None
+        group_by_clause = items[2].children[2]
+        having_clause = items[2].children[3]
+        order_by_clause = items[3]
+        has_aggregate = any(item.data == "aggregate_column" for item in select_list.children)
+        if order_by_clause is not None:
+            has_aggregate = has_aggregate or any(True for node in order_by_clause.find_data("aggregate_function"))
+        order = None
+        if has_aggregate or group_by_clause is not None or having_clause is not None:
+            aggregation = plan_aggregation(joined_cols, select_list, group_by_clause, having_clause, order_by_clause)
+            order = aggregation[4]
+        elif order_by_clause is not None:
+            order = plan_sort(joined_cols, order_by_clause)
+
+        # parse limit clause
+        limit = None
+        offset_num = 0
+        if items[4] is not None:
+            limit = int(items[4].children[1].value)
+            if items[4].children[2] is not None:
+                offset_num = int(items[4].children[2].children[1].value)
+            if limit < 0 or offset_num < 0:
+                print(MY_PROMPT + "Limit and offset must not be negative")
+                return
+        # only the first limit + offset rows of a sorted result are kept
+        top = None
+        if limit is not None and limit + offset_num <= SORT_BUFFER_ROWS:
+            top = limit + offset_num
+
+        # tables whose whole primary key is equated to columns of other tables are probed by key
+        lookups = {}
+        for i, key_cols in plan_index_lookups(join_preds, table_name_list).items():
+            lookups[i] = (key_cols, (table_pool.get(table_name_list[i]), schema_cache.get(table_name_list[i]), table_filters[i]))
+
+        # rows flow through a pipeline of generators: scan -> join -> filter -> project -> limit
+        # a single table is streamed from its cursor, join inputs are read once into buffers
+        relations = []
+        for i in range(len(table_name_list)):
+            if i in lookups:
+                continue
+            schema = schema_cache.get(table_name_list[i])
+            offset = sum(widths[:i])
+            access = plan_index_scan(schema, joined_cols[offset:offset + widths[i]], table_factors[i])
+            rows = scan_rows(schema, access, table_filters[i])
+            if len(table_name_list) > 1:
+                rows = materialize(rows)
+            relations.append(([i], rows))
+
+        # join tables, using index nested loop join on primary keys and hash join for other
+        # equality predicates between tables
+        joined_rows = join_relations(relations, join_preds, widths, lookups)
 
         # check where clause for each row
-        if items[2].children[1] is not None:
-            where_clause = items[2].children[1]
-            bool_expr = where_clause.children[1]
-            size = len(joined_rows)
-            for i in range(size):
-                row = joined_rows.pop(0)
-                test = test_bool_expr(joined_cols, row, bool_expr)
-                if test == True:
-                    joined_rows.append(row)
-        
-        # project rows by selected columns
-        size = len(joined_rows)
-        for i in range(size):
-            row = joined_rows.pop(0)
-            new_row = []
-            size2 = len(joined_cols)
-            for j in range(size2):
-                size3 = len(column_name_list)
-                for k in range(size3):
-                    if column_name_list[k] == joined_cols[j][2] and column_table_name_list[k] == joined_cols[j][0]:
-                        new_row.append(row[j])
-            joined_rows.append(new_row)
-
-        # redundant column name processing with table name
-        for i in range(len(column_name_list)):
-            marked_indices = []
-            for j in range(len(column_name_list)):
-                if i == j:
-                    continue
-                if column_name_list[i] == column_name_list[j]:
-                    marked_indices.append(j)
-            if len(marked_indices) > 0:
-                marked_indices.append(i)
-                for index in marked_indices:
-                    if column_table_alias_list[index] is not None:
-                        added_name = column_table_alias_list[index]
-                    else:
-                        added_name = column_table_name_list[index]
-                    column_name_list[index] = added_name + "." + column_name_list[index]
-
-        # print result
-        width = []
-        for col in column_name_list:
-            w = len(col)
-            for row in joined_rows:
-                w = max(w, len(row[column_name_list.index(col)]))
-            width.append(w)
-        print("+" + "+".join(["-" * (w + 2) for w in width]) + "+")
-
-        print("|" + "|".join([col.center(w + 2) for col, w in zip(column_name_list, width)]) + "|")
-        print("+" + "+".join(["-" * (w + 2) for w in width]) + "+")
-
-        for row in joined_rows:
-            print("|" + "|".join([col.center(w + 2) for col, w in zip(row, width)]) + "|")
-        print("+" + "+".join(["-" * (w + 2) for w in width]) + "+")
+        if where_test is not None:
+            joined_rows = filter_rows(joined_rows, where_test)
+
+        if aggregation is not None:
+            # group rows and compute aggregate functions, then check having clause for each group
+            group_idx, aggregates, having_test, outputs, order = aggregation
+            joined_rows = aggregate_rows(joined_rows, group_idx, aggregates)
+            if having_test is not None:
+                joined_rows = filter_rows(joined_rows, having_test)
+            if order is not None:
+                joined_rows = sort_rows(joined_rows, order, top)
+            joined_rows = project_rows(joined_rows, [output[0] for output in outputs])
+            output_cols = [[output[3], output[4], output[2], None, output[1]] for output in outputs]
+        else:
+            if order is not None:
+                joined_rows = sort_rows(joined_rows, order, top)
+            # select * keeps joined rows as they are
+            if positions != list(range(len(joined_cols))):
+                joined_rows = project_rows(joined_rows, positions)
+            output_cols = [joined_cols[idx] for idx in positions]
+
+        # stop reading rows once the limit is reached
+        if limit is not None or offset_num > 0:
+            joined_rows = limit_rows(joined_rows, limit, offset_num)
+
+        # print result in the output mode chosen by SET OUTPUT
+        output_settings.write(output_column_names(output_cols), [col[4] for col in output_cols], joined_rows)
+
+    # items[0] == Token "SET"
+    # items[1] == Token "OUTPUT"
+    # items[2] == Tree "output_mode"
+    # items[3] == Tree "output_file"
+    def set_output_query(self, items):
+        mode_tree = items[2]
+        mode = mode_tree.children[0].value.lower()
+        sample_rows = ALIGNED_SAMPLE_ROWS
+        if mode == "aligned" and mode_tree.children[1] is not None:
+            sample_rows = int(mode_tree.children[1].value)
+            if sample_rows < 1:
+                print(MY_PROMPT + "Set output has failed: number of rows must be positive")
+                return
+        file_name = None
+        if items[3] is not None:
+            file_name = items[3].children[1].value[1:-1]
+        output_settings.mode = mode
+        output_settings.sample_rows = sample_rows
+        output_settings.file_name = file_name
+        if file_name is None:
+            print(MY_PROMPT + "Output mode is set to " + mode)
+        else:
+            print(MY_PROMPT + "Output mode is set to " + mode + " into '" + file_name + "'")
 
     # items[0] == Token "INSERT"
     # items[1] == Token "INTO"
     # items[2] == Tree "table_name"
     # items[3] == Tree "column_name_list"
     # items[4] == Token "VALUES"
-    # items[5] == Tree "values"
+    # items[5:] == Tree "value_list" for each row
     def insert_query(self, items):
         table_name = items[2].children[0].value
-        tables = pickle.loads(catalogDB.get(b"tables"))
+        schema = schema_cache.get(table_name)
         # check if table exists
-        if table_name not in tables:
+        if schema is None:
             print(MY_PROMPT + "No such table")
             return
-        table_info = pickle.loads(catalogDB.get(table_name.encode()))
-        columns = table_info["columns"]
-        targetDB = db.DB()
-        targetDB.open('./DB/' + table_name + '.db', dbtype=db.DB_HASH)
+        columns = schema.columns
 
         query_col_list = None
         if items[3] is not None:
             query_col_list = items[3].children[1:-1]
-        value_tree_list = items[5].children[1:-1]
         # check if column list is valid
         if query_col_list is not None:
             if len(query_col_list) != len(columns):
@@ -395,97 +1511,214 @@ class T(Transformer):
                     print(MY_PROMPT + "Insertion has failed: '" + col_name + "' does not exist")
                     return
 
-        PK_col_list = []
-        PK_val_list = []
-        FK_info = {}
-        val_list = []
-        for col_name, col_info in columns.items():
-            if col_info["primary_key"]:
-                PK_col_list.append(col_name)
-                PK_val_list.append(None)
-            if col_info["references"] is not None:
-                FK_info[col_name] = col_info["references"]
-            
-        # check if value list is valid
-        if len(value_tree_list) != len(columns):
-            print(MY_PROMPT + "Insertion has failed: Types are not matched")
-            return
-        for i in range(len(value_tree_list)):
-            # parse token_type, value, and col_info
-            valueTree = value_tree_list[i].children[0]
-            if isinstance(valueTree, str) and valueTree.lower() == "null":
-                token_type = "NULL"
-                value = "null"
-            else:
-                token_type = valueTree.children[0].type.lower()
-                value = valueTree.children[0].value.lower()
+        # resolve the column of each value position once for the whole batch
+        # (column name, column info, column index, max length of char)
+        col_names = schema.col_names
+        targets = []
+        for i in range(len(columns)):
             if query_col_list is not None:
                 col_name = query_col_list[i].children[0].value.lower()
             else:
-                col_name = list(columns.keys())[i]
+                col_name = col_names[i]
             col_info = columns[col_name]
+            max_len = int(col_info["type"][5:-1]) if col_info["type"].startswith("char") else None
+            targets.append((col_name, col_info, schema.col_index[col_name], max_len))
 
-            # check if value is null but column is not nullable
-            if value == "null" and not col_info["nullable"]:
-                print(MY_PROMPT + "Insertion has failed: '" + col_name + "' is not nullable")
+        # check every row before writing any of them
+        rows = []
+        new_keys = set()
+        for value_list_tree in items[5:]:
+            value_tree_list = value_list_tree.children[1:-1]
+            val_list = [None] * len(columns)
+            # check if value list is valid
+            if len(value_tree_list) != len(columns):
+                print(MY_PROMPT + "Insertion has failed: Types are not matched")
                 return
-            
-            # check column type is valid
-            if token_type == "int":
-                if col_info["type"] != "int":
-                    print(MY_PROMPT + "Insertion has failed: Types are not matched")
-                    return
-                try:
-                    int_value = int(value)
-                except ValueError:
-                    print(MY_PROMPT + "Insertion has failed: Types are not matched")
-                    return
-            elif token_type == "str":
-                if not col_info["type"].startswith("char"):
-                    print(MY_PROMPT + "Insertion has failed: Types are not matched")
-                    return
-                value = value[1:-1]
-                max_len = int(col_info["type"][5:-1])
-                value = value[:max_len]
-            elif token_type == "date":
-                if col_info["type"] != "date":
-                    print(MY_PROMPT + "Insertion has failed: Types are not matched")
+            for i in range(len(value_tree_list)):
+                # parse token_type, value, and col_info
+                valueTree = value_tree_list[i].children[0]
+                if isinstance(valueTree, str) and valueTree.lower() == "null":
+                    token_type = "NULL"
+                    value = "null"
+                else:
+                    token_type = valueTree.children[0].type.lower()
+                    value = valueTree.children[0].value.lower()
+                col_name, col_info, col_idx, max_len = targets[i]
+
+                # check if value is null but column is not nullable
+                if value == "null" and not col_info["nullable"]:
+                    print(MY_PROMPT + "Insertion has failed: '" + col_name + "' is not nullable")
                     return
 
-            val_list.append(value)
+                # check column type is valid and convert value into its stored form
+                if token_type == "int":
+                    if col_info["type"] != "int":
+                        print(MY_PROMPT + "Insertion has failed: Types are not matched")
+                        return
+                    try:
+                        value = column_value("int", int(value))
+                    except ValueError:
+                        print(MY_PROMPT + "Insertion has failed: Types are not matched")
+                        return
+                elif token_type == "str":
+                    if max_len is None:
+                        print(MY_PROMPT + "Insertion has failed: Types are not matched")
+                        return
+                    try:
+                        value = column_value("char", value[1:-1], max_len)
+                    except ValueError:
+                        print(MY_PROMPT + "Insertion has failed: Types are not matched")
+                        return
+                elif token_type == "date":
+                    if col_info["type"] != "date":
+                        print(MY_PROMPT + "Insertion has failed: Types are not matched")
+                        return
+                    try:
+                        value = date_to_ordinal(value)
+                    except ValueError:
+                        print(MY_PROMPT + "Insertion has failed: Types are not matched")
+                        return
+                else:
+                    value = None
 
-            if col_info["primary_key"]:
-                PK_val_list[PK_col_list.index(col_name)] = value
+                val_list[col_idx] = value
 
-        # check if primary key is duplicated
-        key_tuple = "*".join(PK_val_list).encode()
-        if targetDB.exists(key_tuple):
-            print(MY_PROMPT + "Insertion has failed: Primary key duplication")
-            return
-        
-        # check if foreign key is valid
-        FKV_list_by_table = {}
-        for col_name, ref_info in FK_info.items():
-            ref_table_name, ref_col_name = ref_info.split(".")
-            if ref_table_name not in FKV_list_by_table:
-                FKV_list_by_table[ref_table_name] = [val_list[list(columns.keys()).index(col_name)]]
-            else:
-                FKV_list_by_table[ref_table_name].append(val_list[list(columns.keys()).index(col_name)])
-
-        for ref_table_name, FKV_list in FKV_list_by_table.items():
-            refDB = db.DB()
-            refDB.open('./DB/' + ref_table_name + '.db', dbtype=db.DB_HASH)
-            key_tuple = "*".join(FKV_list).encode()
-            if not refDB.exists(key_tuple):
-                print(MY_PROMPT + "Insertion has failed: Referential integrity violation")
+            # check if primary key is duplicated, in the table or in the batch
+            key_tuple = schema.key(val_list)
+            if key_tuple in new_keys or key_exists(schema, key_tuple):
+                print(MY_PROMPT + "Insertion has failed: Primary key duplication")
                 return
+            new_keys.add(key_tuple)
+            rows.append((key_tuple, val_list))
+
+        # check if foreign key is valid, each referenced key is looked up once per batch
+        for ref_table_name, fk_cols in schema.foreign_keys.items():
+            ref_schema = schema_cache.get(ref_table_name)
+            checked_keys = set()
+            for key_tuple, val_list in rows:
+                FK_values = [val_list[fk_cols[pk]] for pk in ref_schema.pk_list]
+                # null foreign key does not reference any row
+                if None in FK_values:
+                    continue
+                ref_key = encode_key(ref_schema.pk_kinds, FK_values)
+                if ref_key in checked_keys:
+                    continue
+                if not key_exists(ref_schema, ref_key):
+                    print(MY_PROMPT + "Insertion has failed: Referential integrity violation")
+                    return
+                checked_keys.add(ref_key)
+
+        # Add rows to table and its indexes
+        for key_tuple, val_list in rows:
+            insert_row(schema, key_tuple, val_list)
 
-        # Add row to table
-        val_tuple = "*".join(val_list).encode()
-        targetDB.put(key_tuple, val_tuple)
+        if len(rows) == 1:
+            transactions.report("The row is inserted")
+        else:
+            transactions.report(str(len(rows)) + " row(s) are inserted")
+
+    # items[0] == Token "LOAD"
+    # items[1] == Token "DATA"
+    # items[2] == Token STR
+    # items[3] == Token "INTO"
+    # items[4] == Tree "table_name"
+    def load_data_query(self, items):
+        file_name = items[2].value[1:-1]
+        table_name = items[4].children[0].value.lower()
+        schema = schema_cache.get(table_name)
+        # check if table exists
+        if schema is None:
+            print(MY_PROMPT + "No such table")
+            return
+        if not os.path.isfile(file_name):
+            print(MY_PROMPT + "Load has failed: '" + file_name + "' does not exist")
+            return
 
-        print(MY_PROMPT + "The row is inserted")
-        targetDB.close()
+        # (column name, column kind, nullable, max length of char) in column order
+        targets = []
+        for col_name, kind in zip(schema.col_names, schema.kinds):
+            col_info = schema.columns[col_name]
+            max_len = int(col_info["type"][5:-1]) if kind == "char" else None
+            targets.append((col_name, kind, col_info["nullable"], max_len))
+
+        # keys of the referenced tables are read once instead of being looked up for each row
+        fk_checks = []
+        for ref_table_name, fk_cols in schema.foreign_keys.items():
+            ref_schema = schema_cache.get(ref_table_name)
+            ref_keys = set(key for key, value in scan_items(ref_schema))
+            fk_checks.append(([fk_cols[pk] for pk in ref_schema.pk_list], ref_schema.pk_kinds, ref_keys))
+
+        start_time = time.time()
+        loaded_num = 0
+        batch = []
+        batch_keys = set()
+        error = None
+        with open(file_name, newline="") as file:
+            reader = csv.reader(file)
+            for record in reader:
+                # skip empty lines and a header line naming the columns
+                if len(record) == 0:
+                    continue
+                if reader.line_num == 1 and [field.strip().lower() for field in record] == schema.col_names:
+                    continue
+                error = "line " + str(reader.line_num) + ": "
+                if len(record) != len(targets):
+                    error += "Types are not matched"
+                    break
+                # parse fields into the stored form, empty or null fields are null
+                val_list = []
+                for field, (col_name, kind, nullable, max_len) in zip(record, targets):
+                    if field.strip() == "" or field.strip().lower() == "null":
+                        if not nullable:
+                            error += "'" + col_name + "' is not nullable"
+                            break
+                        val_list.append(None)
+                        continue
+                    try:
+                        value = text_to_value(kind, field, max_len)
+                    except ValueError:
+                        error += "Types are not matched"
+                        break
+                    val_list.append(value)
+                if len(val_list) != len(targets):
+                    break
+                # check if primary key is duplicated
+                key = schema.key(val_list)
+                if key in batch_keys or key_exists(schema, key):
+                    error += "Primary key duplication"
+                    break
+                # check if foreign key is valid
+                fk_valid = True
+                for fk_idx_list, pk_kinds, ref_keys in fk_checks:
+                    FK_values = [val_list[idx] for idx in fk_idx_list]
+                    if None not in FK_values and encode_key(pk_kinds, FK_values) not in ref_keys:
+                        fk_valid = False
+                        break
+                if not fk_valid:
+                    error += "Referential integrity violation"
+                    break
+                error = None
+                batch.append((key, val_list))
+                batch_keys.add(key)
+
+                # write the checked rows once the batch is full
+                if len(batch) >= LOAD_BATCH_ROWS:
+                    for key, val_list in batch:
+                        insert_row(schema, key, val_list)
+                    loaded_num += len(batch)
+                    batch = []
+                    batch_keys = set()
+                    transactions.commit_batch()
+
+        # rows of a batch are written only if the whole batch is valid
+        if error is None:
+            for key, val_list in batch:
+                insert_row(schema, key, val_list)
+            loaded_num += len(batch)
+        else:
+            print(MY_PROMPT + "Load has failed: " + error)
+        elapsed = max(time.time() - start_time, 1e-6)
+        transactions.report(str(loaded_num) + " row(s) are loaded (" + str(int(loaded_num / elapsed)) + " rows/sec)")
 
     # items[0] = TOKEN DELETE
     # items[1] = TOKEN FROM
@@ -493,380 +1726,1109 @@ class T(Transformer):
     # items[3] = TREE where_clause
     def delete_query(self, items):
         table_name = items[2].children[0].value.lower()
-        tables = pickle.loads(catalogDB.get(b"tables"))
-        if table_name not in tables:
+        schema = schema_cache.get(table_name)
+        if schema is None:
             print(MY_PROMPT + "No such table")
             return
         
-        table_info = pickle.loads(catalogDB.get(table_name.encode()))
-        table_columns = list(table_info["columns"].keys())
-        targetDB = db.DB()
-        targetDB.open('./DB/' + table_name + '.db', dbtype=db.DB_HASH)
-        rows = []
-        will_be_deleted_keys = []
-        not_deleted_num = 0
-        for key, value in targetDB.items():
-            value_list = value.decode().split("*")
-            rows.append((key.decode(), value_list))
-        
-        # check where clause for each row
+        # compile where clause before reading any row
+        where_test = None
+        access = None
         if items[3] is not None:
-            cols = []
-            for col in table_columns:
-                cols.append([table_name, None, col, None])
-
-            for row in rows:
-                test = test_bool_expr(cols, row[1], items[3].children[1])
-                if test is True:
-                    will_be_deleted_keys.append(row[0])
-        else:
-            for row in rows:
-                will_be_deleted_keys.append(row[0])
-
-        # check if foreign key is valid
-        size = len(will_be_deleted_keys)
-        for i in range(size):
-            PK_values = will_be_deleted_keys[i].strip("'").split("*")
-
-            ref_tables = table_info["referenced_by"]
-            for ref_table_name in ref_tables:
-                can_set_null = True
-                referencing_row_exist = True
-                fk_idx_list = []
-                ref_table_info = pickle.loads(catalogDB.get(ref_table_name.encode()))
-                ref_table_columns = ref_table_info["columns"]
-                idx = -1
-                for col_name, column_info in ref_table_columns.items():
-                    idx += 1
-                    if column_info["references"] is None:
-                        continue
-                    if column_info["references"].startswith(table_name) and column_info["nullable"] == False:
-                        can_set_null = False
-                        fk_idx_list.append(idx)
-                        continue
-                
-                refDB = db.DB()
-                refDB.open('./DB/' + ref_table_name + '.db', dbtype=db.DB_HASH)
-                for key, value in refDB.items():
-                    referencing_row_exist = True
-                    value_list = value.decode().split("*")
-                    for idx in fk_idx_list:
-                        if value_list[idx] not in PK_values:
-                            referencing_row_exist = False
-                            break
+            where_test = compile_where(schema.cols(), items[3].children[1])
+            access = plan_index_scan(schema, schema.cols(), split_conjuncts(items[3].children[1]))
 
-                if not can_set_null and referencing_row_exist:
-                    will_be_deleted_keys[i] = None
-                    not_deleted_num += 1
-
-        # delete rows
+        codec = schema.codec
         deleted_number = 0
-        for key in will_be_deleted_keys:
-            if key is not None:
-                targetDB.delete(key.encode())
-                pk_list = key.strip("'").split("*")
-                # set null to referencing rows
-                for ref_table_name in ref_tables:
-                    refDB = db.DB()
-                    refDB.open('./DB/' + ref_table_name + '.db', dbtype=db.DB_HASH)
-                    for ref_key, ref_value in refDB.items():
-                        to_be_null = True
-                        value_list = ref_value.decode().split("*")
-                        for i in range(len(pk_list)):
-                            if pk_list[i] not in value_list:
-                                to_be_null = False
-                                break
-                        if to_be_null:
-                            for i in range(len(pk_list)):
-                                value_list[value_list.index(pk_list[i])] = "null"
-                            refDB.put(ref_key, "*".join(value_list).encode())
-                    refDB.close()
+        not_deleted_num = 0
+        # when other tables reference this one, the keys of the rows to be deleted are collected
+        # first and every referencing table is checked once for all of them
+        candidates = None
+        blocked = set()
+        set_null_rows = None
+        if len(schema.referencing) > 0:
+            candidates = set()
+            for key, value in scan_items(schema, access):
+                if where_test is None or where_test(codec.decode(value)):
+                    candidates.add(key)
+            blocked, set_null_rows = check_referencing_rows(schema, candidates)
+            not_deleted_num = len(blocked)
+
+        # rows are deleted while they are scanned, outside BEGIN ... COMMIT the deletes are
+        # committed every DML_BATCH_ROWS rows unless referencing rows are set null after the
+        # scan, a committed batch must not leave foreign keys to deleted rows
+        batched = set_null_rows is None or len(set_null_rows) == 0
+        try:
+            for cursor, key, value in scan_items_for_write(schema, access, batched):
+                if candidates is not None:
+                    if key not in candidates or key in blocked:
+                        continue
+                    value_list = codec.decode(value)
+                else:
+                    value_list = codec.decode(value)
+                    # check where clause for each row
+                    if where_test is not None and not where_test(value_list):
+                        continue
+                delete_row(schema, key, value_list, cursor)
                 deleted_number += 1
 
-        targetDB.close()
-        print(MY_PROMPT + str(deleted_number) + " row(s) are deleted")
+            # set null to referencing rows
+            if set_null_rows is not None:
+                for i, ref_key in set_null_rows:
+                    ref_schema, fk_index, can_set_null = schema.referencing[i]
+                    value = table_pool.get(ref_schema.name).get(ref_key, txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+                    # a row of the same table may be deleted already
+                    if value is None:
+                        continue
+                    value_list = ref_schema.codec.decode(value)
+                    new_value_list = value_list.copy()
+                    for idx in fk_index.col_idx_list:
+                        new_value_list[idx] = None
+                    update_row(ref_schema, ref_key, value_list, ref_key, new_value_list)
+        finally:
+            if set_null_rows is not None:
+                set_null_rows.close()
+
+        transactions.report(str(deleted_number) + " row(s) are deleted")
         if not_deleted_num > 0:
-            print(MY_PROMPT + str(not_deleted_num) + " row(s) are not deleted due to referential integrity")
+            transactions.report(str(not_deleted_num) + " row(s) are not deleted due to referential integrity")
     # items[0] = TOKEN UPDATE
     # items[1] = TREE table_name
     # items[2] = Token SET
-    # items[3] = TREE column_name
-    # items[4] = TOKEN COMP_OP
-    # items[5] = TREE comparable_value
-    # items[6] = TREE where_clause
+    # items[3:-1] = TREE assignment for each column
+    # items[-1] = TREE where_clause
     def update_query(self, items):
         table_name = items[1].children[0].value.lower()
-        column_name = items[3].children[0].value.lower()
-        value = items[5].children[0].value.lower()
-        value_type = operand_type(value)
-
-        tables = pickle.loads(catalogDB.get(b"tables"))
-        if table_name not in tables:
+        schema = schema_cache.get(table_name)
+        if schema is None:
             print(MY_PROMPT + "No such table")
             return
-        
-        table_info = pickle.loads(catalogDB.get(table_name.encode()))
-        table_columns = list(table_info["columns"].keys())
-        column_info = table_info["columns"][column_name]
-        ref_tables = table_info["referenced_by"]
-        # check if column exists
-        if column_name not in table_columns:
-            print(MY_PROMPT + "Update has failed: '" + column_name + "' does not exist")
-            return
-        # check type match
-        if column_info["type"] == "int":
-            try:
-                int_value = int(value)
-            except ValueError:
-                print(MY_PROMPT + "Update has failed: Types are not matched")
+
+        # check every assignment once and convert its value into its stored form
+        # {column index: value}
+        assigned = {}
+        for assignment in items[3:-1]:
+            column_name = assignment.children[0].children[0].value.lower()
+            token = assignment.children[2].children[0]
+            # check if column exists
+            if column_name not in schema.col_index:
+                print(MY_PROMPT + "Update has failed: '" + column_name + "' does not exist")
                 return
-        elif column_info["type"] == "date":
-            if value_type != "date":
-                print(MY_PROMPT + "Update has failed: Types are not matched")
+            col_idx = schema.col_index[column_name]
+            if col_idx in assigned:
+                print(MY_PROMPT + "Update has failed: column is duplicated")
                 return
-        else:
-            if value_type != "str":
+            column_info = schema.columns[column_name]
+            # check type match
+            kind = column_kind(column_info["type"])
+            value = literal_value(kind, token)
+            # strings are stored in lower case, as INSERT stores them
+            if kind == "char" and value is not None:
+                value = value.lower()
+            max_len = int(column_info["type"][5:-1]) if kind == "char" else None
+            try:
+                value = None if value is None else column_value(kind, value, max_len)
+            except ValueError:
+                value = None
+            if value is None:
                 print(MY_PROMPT + "Update has failed: Types are not matched")
                 return
-            value = value[1:-1]
-            max_len = int(column_info["type"][5:-1])
-            value = value[:max_len]
-        
-        targetDB = db.DB()
-        targetDB.open('./DB/' + table_name + '.db', dbtype=db.DB_HASH)
+            assigned[col_idx] = value
+
+        # compile where clause before reading any row
+        where_test = None
+        access = None
+        where_clause = items[-1]
+        if where_clause is not None:
+            where_test = compile_where(schema.cols(), where_clause.children[1])
+            access = plan_index_scan(schema, schema.cols(), split_conjuncts(where_clause.children[1]))
+
+        codec = schema.codec
         updated_num = 0
         not_updated_num = 0
-        will_be_updated_list = []
-        col_idx = table_columns.index(column_name)
-
-        for key, val in targetDB.items():
-            key_list = key.decode().split("*")
-            val_list = val.decode().split("*")
-            old_pk = None
-            # check where clause for each row
-            will_be_updated = False
-            if items[6] is not None:
-                cols = []
-                for col in table_columns:
-                    cols.append([table_name, None, col, None])
-                test = test_bool_expr(cols, val_list, items[6].children[1])
-                if test is True:
-                    will_be_updated = True
-            else:
-                will_be_updated= True
-
-            if not will_be_updated:
-                continue
+        new_keys = set()
+        pk_idx_list = schema.pk_idx_list
+        changes_pk = any(idx in assigned for idx in pk_idx_list)
+        # foreign keys having an assigned column, their new values are checked before any write
+        changed_fks = []
+        for ref_table_name, fk_cols in schema.foreign_keys.items():
+            if any(idx in assigned for idx in fk_cols.values()):
+                ref_schema = schema_cache.get(ref_table_name)
+                changed_fks.append((ref_schema, [fk_cols[pk] for pk in ref_schema.pk_list], set()))
+
+        # rows are updated in place while they are scanned; rows moved to a new primary key, or
+        # within the index being scanned, are written after the scan so that it does not meet
+        # them again, and so are all rows when a check on a later row can still make the update fail
+        # Only updates in place, which change neither keys nor foreign keys, are committed every
+        # DML_BATCH_ROWS rows outside BEGIN ... COMMIT; deferred rows are written in one transaction
+        deferred = None
+        if changes_pk or len(changed_fks) > 0 or (access is not None and any(idx in assigned for idx in access.index.col_idx_list)):
+            deferred = RowBuffer()
+        try:
+            for cursor, key, val in scan_items_for_write(schema, access, deferred is None):
+                val_list = codec.decode(val)
+                # check where clause for each row
+                if where_test is not None and not where_test(val_list):
+                    continue
 
-            if column_info["primary_key"] == True:
-                # check primary key constraint
-                pk_list = table_info["pk_list"]
-                pk_idx = pk_list.index(column_name)
-                old_pk = key_list.copy()
-                new_pk = key_list.copy()
-                new_pk[pk_idx] = value
-                new_pk = "*".join(new_pk)
-                if targetDB.has_key(new_pk.encode()):
-                    print(MY_PROMPT + "Update has failed: Primary key duplication")
-                    return
-                key_list = new_pk.split("*")
-                # check tables that reference this table
-                for ref_table_name in ref_tables:
-                    can_set_null = True
-                    referencing_row_exist = True
-                    fk_idx_list = []
-                    idx = -1
-                    ref_table_info = pickle.loads(catalogDB.get(ref_table_name.encode()))
-                    ref_table_columns = ref_table_info["columns"]
-                    # check if can set null
-                    for col_name, column_info in ref_table_columns.items():
-                        idx += 1
-                        if column_info["references"] is None:
-                            continue
-                        if column_info["references"].startswith(table_name) and column_info["nullable"] == False:
-                            can_set_null = False
-                            fk_idx_list.append(idx)
-                            continue
-                    # check if referencing row exists
-                    refDB = db.DB()
-                    refDB.open('./DB/' + ref_table_name + '.db', dbtype=db.DB_HASH)
-                    for ref_key, ref_value in refDB.items():
-                        referencing_row_exist = True
-                        ref_val_list = ref_value.decode().split("*")
-                        if old_pk is not None:
-                            pk_val_list = old_pk.copy()
-                        else:
-                            pk_val_list = key_list.copy()
-                        for idx in fk_idx_list:
-                            if ref_val_list[idx] not in pk_val_list:
-                                referencing_row_exist = False
-                                refDB.close()
+                new_val_list = val_list.copy()
+                for col_idx, value in assigned.items():
+                    new_val_list[col_idx] = value
+                new_key = key
+                if changes_pk:
+                    # check primary key constraint
+                    new_key = schema.key(new_val_list)
+                    if new_key != key and (new_key in new_keys or key_exists(schema, new_key)):
+                        print(MY_PROMPT + "Update has failed: Primary key duplication")
+                        return
+                    # check tables that reference this table
+                    if new_key != key:
+                        PK_values = [val_list[idx] for idx in pk_idx_list]
+                        referenced = False
+                        for ref_schema, fk_index, can_set_null in schema.referencing:
+                            if not can_set_null and has_referencing_row(fk_index, PK_values):
+                                referenced = True
                                 break
-                    if not can_set_null and referencing_row_exist:
-                        not_updated_num += 1
-                        will_be_updated = False
-                        refDB.close()
-                        break
-                    refDB.close()
-
-            # append update list
-            if will_be_updated:
-                will_be_updated_list.append([key_list, val_list, col_idx, value, old_pk])
-
-        # update rows
-        for row in will_be_updated_list:
-            key_list = row[0]
-            val_list = row[1]
-            col_idx = row[2]
-            value = row[3]
-            old_pk = row[4]
-            val_list[col_idx] = value
-            if old_pk is None:
-                targetDB.put("*".join(key_list).encode(), "*".join(val_list).encode())
-            else:
-                targetDB.delete("*".join(old_pk).encode())
-                targetDB.put("*".join(key_list).encode(), "*".join(val_list).encode())
-            updated_num += 1
-        targetDB.close()
+                        if referenced:
+                            not_updated_num += 1
+                            continue
+                    new_keys.add(new_key)
 
-        print(MY_PROMPT + str(updated_num) + " row(s) are updated")
+                # check the tables referenced by the changed foreign keys
+                for ref_schema, fk_idx_list, checked_keys in changed_fks:
+                    FK_values = [new_val_list[idx] for idx in fk_idx_list]
+                    # null foreign key does not reference any row
+                    if None in FK_values:
+                        continue
+                    ref_key = encode_key(ref_schema.pk_kinds, FK_values)
+                    if ref_key in checked_keys:
+                        continue
+                    if not key_exists(ref_schema, ref_key):
+                        print(MY_PROMPT + "Update has failed: Referential integrity violation")
+                        return
+                    checked_keys.add(ref_key)
+
+                if deferred is not None:
+                    deferred.append((key, val_list, new_key, new_val_list))
+                    continue
+                update_row(schema, key, val_list, new_key, new_val_list, cursor)
+                updated_num += 1
+
+            # update deferred rows and their index entries
+            if deferred is not None:
+                for key, val_list, new_key, new_val_list in deferred:
+                    update_row(schema, key, val_list, new_key, new_val_list)
+                    updated_num += 1
+        finally:
+            if deferred is not None:
+                deferred.close()
+
+        transactions.report(str(updated_num) + " row(s) are updated")
         if not_updated_num != 0:
-            print(MY_PROMPT + str(not_updated_num) + " row(s) are not updated due to referential integrity")
+            transactions.report(str(not_updated_num) + " row(s) are not updated due to referential integrity")
 
-    def EXIT(self, items):
-        raise SystemExit
+    def begin_query(self, items):
+        if transactions.user_txn is not None:
+            print(MY_PROMPT + "Begin has failed: transaction is already started")
+            return
+        transactions.begin()
+        print(MY_PROMPT + "Transaction is started")
 
-# Helper functions for parsing where clause
-def test_bool_expr(cols, vals, expr_tree):
-    answer = False
-    for i in range(0, len(expr_tree.children), 2):
-        answer = answer or test_bool_term(cols, vals, expr_tree.children[i])
-    return answer
+    def commit_query(self, items):
+        if transactions.user_txn is None:
+            print(MY_PROMPT + "No transaction is started")
+            return
+        # the commit statement itself is the last child of the transaction
+        transactions.txn.commit()
+        transactions.txn = None
+        transactions.commit(transactions.user_txn)
+        transactions.user_txn = None
+        print(MY_PROMPT + "Transaction is committed")
+
+    def rollback_query(self, items):
+        if transactions.user_txn is None:
+            print(MY_PROMPT + "No transaction is started")
+            return
+        transactions.txn.abort()
+        transactions.rollback()
+        print(MY_PROMPT + "Transaction is rolled back")
 
-def test_bool_term(cols, vals, term_tree):
-    answer = True
-    for i in range(0, len(term_tree.children), 2):
-        answer = answer and test_bool_factor(cols, vals, term_tree.children[i])
-    return answer
+    # items[0] == Token "SET"
+    # items[1] == Token "DURABILITY"
+    # items[2] == Tree durability_level
+    def set_durability_query(self, items):
+        transactions.durability = items[2].children[0].value.lower()
+        print(MY_PROMPT + "Durability is set to " + transactions.durability + ": " + DURABILITY_NOTES[transactions.durability])
 
-def test_bool_factor(cols, vals, factor_tree):
-    if factor_tree.children[0] is None:
-        return test_bool_test(cols, vals, factor_tree.children[1])
-    else:
-        return not test_bool_test(cols, vals, factor_tree.children[1])
+    def EXIT(self, items):
+        raise SystemExit
 
-def test_bool_test(cols, vals, test_tree):
-    if len(test_tree.children) == 1:
-        return test_predicate(cols, vals, test_tree.children[0])
+# Helper functions for joining tables
+# Split a where clause into the factors joined by AND, None if it has OR at the top level
+def split_conjuncts(expr_tree):
+    if len(expr_tree.children) != 1:
+        return None
+    factors = []
+    for factor in expr_tree.children[0].children[0::2]:
+        node = factor.children[1].children[0]
+        if factor.children[0] is None and node.data == "parenthesized_boolean_expr":
+            inner = split_conjuncts(node.children[1])
+            if inner is not None:
+                factors.extend(inner)
+                continue
+        factors.append(factor)
+    return factors
+
+# Resolve a column reference to (table index, column index) in the from clause, None if it is
+# not a column of exactly one table
+def resolve_column(table_tree, column_tree, table_name_list, table_alias_list):
+    col_name = column_tree.children[0].value.lower()
+    found = None
+    for i in range(len(table_name_list)):
+        if table_tree is not None:
+            name = table_tree.children[0].value.lower()
+            if name != table_name_list[i] and name != table_alias_list[i]:
+                continue
+        schema = schema_cache.get(table_name_list[i])
+        if col_name in schema.col_index:
+            if found is not None:
+                return None
+            found = (i, schema.col_index[col_name])
+    return found
+
+# Find "a.x = b.y" conjuncts comparing columns of the same type from two different tables
+def find_join_predicates(expr_tree, table_name_list, table_alias_list):
+    join_preds = []
+    factors = split_conjuncts(expr_tree)
+    if factors is None:
+        return join_preds
+    for factor in factors:
+        node = factor.children[1].children[0]
+        if factor.children[0] is not None or node.data != "predicate":
+            continue
+        comp = node.children[0]
+        if comp.data != "comparison_predicate" or comp.children[1].value != "=":
+            continue
+        operands = []
+        for operand in (comp.children[0], comp.children[2]):
+            if len(operand.children) == 2:
+                operands.append(resolve_column(operand.children[0], operand.children[1], table_name_list, table_alias_list))
+            else:
+                operands.append(None)
+        if operands[0] is None or operands[1] is None or operands[0][0] == operands[1][0]:
+            continue
+        kind1 = schema_cache.get(table_name_list[operands[0][0]]).kinds[operands[0][1]]
+        kind2 = schema_cache.get(table_name_list[operands[1][0]]).kinds[operands[1][1]]
+        if kind1 == kind2:
+            join_preds.append((operands[0][0], operands[0][1], operands[1][0], operands[1][1]))
+    return join_preds
+
+# Split a where clause into a filter for each table and a filter over the joined rows
+# Conjuncts referencing the columns of a single table are compiled against that table only,
+# and are also returned per table so that a secondary index can be chosen for them
+def push_down_predicates(joined_cols, widths, expr_tree):
+    table_filters = [None] * len(widths)
+    factors = split_conjuncts(expr_tree)
+    if factors is None:
+        return table_filters, [None] * len(widths), compile_where(joined_cols, expr_tree)
+
+    offsets = [sum(widths[:i]) for i in range(len(widths))]
+    col_tables = [i for i in range(len(widths)) for j in range(widths[i])]
+    table_tests = [[] for i in range(len(widths))]
+    table_factors = [[] for i in range(len(widths))]
+    residual_tests = []
+    for factor in factors:
+        # resolving every column reference also validates the factor against all tables
+        referenced = set()
+        for node in factor.iter_subtrees():
+            if node.data == "comp_operand" and len(node.children) == 2:
+                referenced.add(col_tables[resolve_operand(joined_cols, node.children[0], node.children[1])])
+            elif node.data == "null_predicate":
+                referenced.add(col_tables[resolve_operand(joined_cols, node.children[0], node.children[1])])
+        if len(referenced) == 1:
+            i = referenced.pop()
+            table_tests[i].append(compile_bool_factor(joined_cols[offsets[i]:offsets[i] + widths[i]], factor))
+            table_factors[i].append(factor)
+        else:
+            residual_tests.append(compile_bool_factor(joined_cols, factor))
+
+    for i in range(len(widths)):
+        if len(table_tests[i]) > 0:
+            table_filters[i] = all_of(table_tests[i])
+    where_test = all_of(residual_tests) if len(residual_tests) > 0 else None
+    return table_filters, table_factors, where_test
+
+def all_of(tests):
+    if len(tests) == 1:
+        return tests[0]
+    return lambda row: all(test(row) for test in tests)
+
+# Choose the tables to be read by primary key lookups: every primary key column must be equated
+# to a column of a table that is scanned, and at least one table must be scanned
+# Returns {table index: [(table index, column index) providing each primary key column]}
+def plan_index_lookups(join_preds, table_name_list):
+    lookups = {}
+    providers = set()
+    for t in range(len(table_name_list)):
+        if t in providers or len(lookups) + 1 >= len(table_name_list):
+            continue
+        schema = schema_cache.get(table_name_list[t])
+        key_cols = []
+        for pk_idx in schema.pk_idx_list:
+            provider = None
+            for ti, ci, tj, cj in join_preds:
+                if tj == t and cj == pk_idx and ti not in lookups:
+                    provider = (ti, ci)
+                elif ti == t and ci == pk_idx and tj not in lookups:
+                    provider = (tj, cj)
+                if provider is not None:
+                    break
+            if provider is None:
+                break
+            key_cols.append(provider)
+        if len(key_cols) == len(schema.pk_idx_list):
+            lookups[t] = key_cols
+            providers.update(ti for ti, ci in key_cols)
+    return lookups
+
+# Join relations given as (table index list, RowBuffer) into rows laid out in from clause order
+# lookups maps the tables read by primary key to (key columns, (handle, schema, table filter)),
+# they are joined by index nested loop join as soon as one relation provides their whole key
+# Relations connected by a join predicate are hash joined, the others are block nested loop joined
+def join_relations(relations, join_preds, widths, lookups={}):
+    relations = list(relations)
+    pending = dict(lookups)
+    while len(relations) > 1 or len(pending) > 0:
+        step = None
+        for t, (key_cols, probe) in pending.items():
+            for rel in relations:
+                if all(ti in rel[0] for ti, ci in key_cols):
+                    step = (t, rel)
+                    break
+            if step is not None:
+                break
+        if step is not None:
+            t, rel = step
+            key_cols, probe = pending.pop(t)
+            key_idx = [column_offset(rel[0], ti, widths) + ci for ti, ci in key_cols]
+            rows = index_nested_loop_join(rel[1], key_idx, probe)
+            relations.remove(rel)
+            relations.append((rel[0] + [t], rows))
+            continue
+
+        left = right = None
+        for ti, ci, tj, cj in join_preds:
+            rel_i = next((rel for rel in relations if ti in rel[0]), None)
+            rel_j = next((rel for rel in relations if tj in rel[0]), None)
+            if rel_i is not None and rel_j is not None and rel_i is not rel_j:
+                left, right = rel_i, rel_j
+                break
+        if left is None:
+            left, right = relations[0], relations[1]
+            rows = block_nested_loop_join(left[1], right[1])
+        else:
+            # collect every predicate between the two relations as a composite key
+            left_key = []
+            right_key = []
+            for ti, ci, tj, cj in join_preds:
+                if ti in left[0] and tj in right[0]:
+                    left_key.append(column_offset(left[0], ti, widths) + ci)
+                    right_key.append(column_offset(right[0], tj, widths) + cj)
+                elif tj in left[0] and ti in right[0]:
+                    left_key.append(column_offset(left[0], tj, widths) + cj)
+                    right_key.append(column_offset(right[0], ti, widths) + ci)
+            rows = hash_join(left[1], left_key, right[1], right_key)
+        relations.remove(left)
+        relations.remove(right)
+        relations.append((left[0] + right[0], rows))
+
+    # reorder columns of the joined rows into from clause order
+    table_list, rows = relations[0]
+    if table_list == sorted(table_list):
+        return rows
+    positions = []
+    for i in range(len(widths)):
+        offset = column_offset(table_list, i, widths)
+        positions.extend(range(offset, offset + widths[i]))
+    return reorder_rows(rows, positions)
+
+def reorder_rows(rows, positions):
+    try:
+        for row in rows:
+            yield [row[p] for p in positions]
+    finally:
+        rows.close()
+
+def column_offset(table_list, table_idx, widths):
+    offset = 0
+    for i in table_list:
+        if i == table_idx:
+            return offset
+        offset += widths[i]
+
+# Join each outer row with the inner row found by its primary key
+def index_nested_loop_join(outer_rows, key_idx, probe):
+    targetDB, schema, table_filter = probe
+    try:
+        for row in outer_rows:
+            key = [row[i] for i in key_idx]
+            if None in key:
+                continue
+            value = targetDB.get(encode_key(schema.pk_kinds, key), txn=transactions.txn, flags=db.DB_READ_COMMITTED)
+            if value is None:
+                continue
+            inner_row = schema.codec.decode(value)
+            if table_filter is None or table_filter(inner_row):
+                yield row + inner_row
+    finally:
+        outer_rows.close()
+
+# Equi-join building the hash table on the smaller buffered input and streaming the other one,
+# rows with a null key never match
+def hash_join(left_rows, left_key, right_rows, right_key):
+    if isinstance(left_rows, RowBuffer) and isinstance(right_rows, RowBuffer):
+        build_left = len(left_rows) <= len(right_rows)
     else:
-        return test_bool_expr(cols, vals, test_tree.children[1])
-
-def test_predicate(cols, vals, pred_tree):
-    node = pred_tree.children[0]
-    if node.data == "comparison_predicate":
-        return test_comparison_predicate(cols, vals, node)
-    elif node.data == "null_predicate":
-        return test_null_predicate(cols, vals, node)
-
-def parse_operand(cols, vals, operand_tree):
-    # constant value
-    if operand_tree.children[0] is not None and operand_tree.children[0].data == "comparable_value":
-        if operand_tree.children[0].children[0].value.startswith("'"):
-            return operand_tree.children[0].children[0].value[1:-1]
-        return str(operand_tree.children[0].children[0].value)
+        build_left = isinstance(left_rows, RowBuffer)
+    if build_left:
+        build_rows, build_key, probe_rows, probe_key = left_rows, left_key, right_rows, right_key
+    else:
+        build_rows, build_key, probe_rows, probe_key = materialize(right_rows), right_key, left_rows, left_key
+    try:
+        table = {}
+        for row in build_rows:
+            key = tuple(row[i] for i in build_key)
+            if None in key:
+                continue
+            table.setdefault(key, []).append(row)
+        build_rows.close()
+        for row in probe_rows:
+            key = tuple(row[i] for i in probe_key)
+            matches = table.get(key)
+            if matches is None:
+                continue
+            for match in matches:
+                yield match + row if build_left else row + match
+    finally:
+        build_rows.close()
+        probe_rows.close()
+
+# Cross join reading the inner input once per block of outer rows
+# While the inner input fits in memory every outer row is joined directly against it
+def block_nested_loop_join(outer, inner):
+    inner = materialize(inner)
+    try:
+        if not inner.spilled():
+            for outer_row in outer:
+                for inner_row in inner.rows:
+                    yield outer_row + inner_row
+            return
+        block = []
+        for outer_row in outer:
+            block.append(outer_row)
+            if len(block) >= inner.budget:
+                yield from join_block(block, inner)
+                block = []
+        if len(block) > 0:
+            yield from join_block(block, inner)
+    finally:
+        outer.close()
+        inner.close()
+
+def join_block(block, inner):
+    for inner_row in inner:
+        for outer_row in block:
+            yield outer_row + inner_row
+
+# Read rows into a RowBuffer unless they already are in one
+def materialize(rows):
+    if isinstance(rows, RowBuffer):
+        return rows
+    buffer = RowBuffer()
+    for row in rows:
+        buffer.append(row)
+    return buffer
+
+# Pipeline operators of select, each one pulls rows from its input only when asked for a row
+def scan_rows(schema, access, table_filter):
+    for key, value in scan_items(schema, access):
+        row = schema.codec.decode(value)
+        if table_filter is None or table_filter(row):
+            yield row
+
+def filter_rows(rows, test):
+    for row in rows:
+        if test(row):
+            yield row
+
+# Rows are projected into tuples of the values at positions
+def project_rows(rows, positions):
+    if len(positions) == 1:
+        position = positions[0]
+        getter = lambda row: (row[position],)
+    else:
+        getter = operator.itemgetter(*positions)
+    for row in rows:
+        yield getter(row)
 
+def resolve_select_column(cols, table_tree, column_tree):
+    try:
+        return resolve_operand(cols, table_tree, column_tree)
+    except Exception:
+        raise Exception("SelectColumnResolveError", column_tree.children[0].value.lower())
+
+# Output names of selected columns, a column alias replaces the column name and names
+# appearing more than once are qualified by the table alias or table name
+def output_column_names(output_cols):
+    names = [col[2] if col[3] is None else col[3] for col in output_cols]
+    output_names = []
+    for col, name in zip(output_cols, names):
+        table = col[0] if col[1] is None else col[1]
+        # aggregate functions do not belong to a table
+        if names.count(name) > 1 and table is not None:
+            name = table + "." + name
+        output_names.append(name)
+    return output_names
+
+# Result writers, each one writes the rows as they come except the table mode which needs
+# every row to find the width of the columns
+class OutputSettings():
+    # Output mode of select chosen by SET OUTPUT: "table", "aligned", "csv" or "json",
+    # written to the standard output or to file_name, which is rewritten by every select
+    def __init__(self):
+        self.mode = "table"
+        self.sample_rows = ALIGNED_SAMPLE_ROWS
+        self.file_name = None
+
+    # rows hold stored values, which each writer formats by the kinds of the columns
+    def write(self, column_names, kinds, rows):
+        out = sys.stdout if self.file_name is None else open(self.file_name, "w", newline="")
+        try:
+            if self.mode == "aligned":
+                row_num = write_aligned(column_names, text_rows(kinds, rows), out, self.sample_rows)
+            elif self.mode == "csv":
+                row_num = write_csv(column_names, kinds, rows, out)
+            elif self.mode == "json":
+                row_num = write_json_lines(column_names, kinds, rows, out)
+            else:
+                row_num = write_table(column_names, text_rows(kinds, rows), out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if out is not sys.stdout:
+            print(MY_PROMPT + str(row_num) + " row(s) are written into '" + self.file_name + "'")
+
+output_settings = OutputSettings()
+
+def text_rows(kinds, rows):
+    for row in rows:
+        yield [value_to_text(kind, value) for kind, value in zip(kinds, row)]
+
+def write_table(column_names, rows, out):
+    # rows are buffered while the width of each column is found
+    width = [len(col) for col in column_names]
+    result_rows = RowBuffer()
+    for row in rows:
+        for i in range(len(width)):
+            width[i] = max(width[i], len(row[i]))
+        result_rows.append(row)
+    print("+" + "+".join(["-" * (w + 2) for w in width]) + "+", file=out)
+
+    print("|" + "|".join([col.center(w + 2) for col, w in zip(column_names, width)]) + "|", file=out)
+    print("+" + "+".join(["-" * (w + 2) for w in width]) + "+", file=out)
+
+    for row in result_rows:
+        print("|" + "|".join([col.center(w + 2) for col, w in zip(row, width)]) + "|", file=out)
+    print("+" + "+".join(["-" * (w + 2) for w in width]) + "+", file=out)
+    result_rows.close()
+    return len(result_rows)
+
+# Table layout sized by the first sample_rows rows only, longer values of later rows overflow
+def write_aligned(column_names, rows, out, sample_rows):
+    width = [len(col) for col in column_names]
+    sample = []
+    for row in rows:
+        sample.append(row)
+        for i in range(len(width)):
+            width[i] = max(width[i], len(row[i]))
+        if len(sample) >= sample_rows:
+            break
+    print("+" + "+".join(["-" * (w + 2) for w in width]) + "+", file=out)
+    print("|" + "|".join([col.center(w + 2) for col, w in zip(column_names, width)]) + "|", file=out)
+    print("+" + "+".join(["-" * (w + 2) for w in width]) + "+", file=out)
+    row_num = 0
+    for part in (sample, rows):
+        for row in part:
+            print("|" + "|".join([col.center(w + 2) for col, w in zip(row, width)]) + "|", file=out)
+            row_num += 1
+    print("+" + "+".join(["-" * (w + 2) for w in width]) + "+", file=out)
+    return row_num
+
+# Header line then one line per row, null is written as an empty field as read by LOAD DATA
+def write_csv(column_names, kinds, rows, out):
+    writer = csv.writer(out)
+    writer.writerow(column_names)
+    row_num = 0
+    for row in rows:
+        writer.writerow(["" if value is None else value_to_text(kind, value) for kind, value in zip(kinds, row)])
+        row_num += 1
+    return row_num
+
+# One JSON object per row keyed by column name, ints are written as numbers and dates as text
+def write_json_lines(column_names, kinds, rows, out):
+    row_num = 0
+    for row in rows:
+        record = {}
+        for name, kind, value in zip(column_names, kinds, row):
+            record[name] = value_to_text(kind, value) if kind == "date" and value is not None else value
+        out.write(json.dumps(record) + "\n")
+        row_num += 1
+    return row_num
+
+# Helper functions for group by and aggregate functions
+# Name of an aggregate function used as its column name, "count(*)", "sum(e.age)", ...
+def aggregate_key(func_tree):
+    argument = func_tree.children[2]
+    if len(argument.children) == 0:
+        target = "*"
+    elif argument.children[0] is not None:
+        target = argument.children[0].children[0].value.lower() + "." + argument.children[1].children[0].value.lower()
+    else:
+        target = argument.children[1].children[0].value.lower()
+    return func_tree.children[0].value.lower() + "(" + target + ")"
+
+class Aggregate():
+    # Aggregate function over the column at idx of the input rows, idx is None for count(*)
+    # The running state of a group is an int for count, a value for sum / min / max and
+    # [sum, count] for avg; null values are ignored
+    def __init__(self, func, idx, kind):
+        self.func = func
+        self.idx = idx
+        # avg gives a float which is compared and printed like an int
+        self.kind = kind if func in ("min", "max") else "int"
+
+    def initial(self):
+        if self.func == "count":
+            return 0
+        if self.func == "avg":
+            return [0, 0]
+        return None
+
+    def update(self, state, row):
+        if self.idx is None:
+            return state + 1
+        value = row[self.idx]
+        if value is None:
+            return state
+        if self.func == "count":
+            return state + 1
+        if self.func == "avg":
+            state[0] += value
+            state[1] += 1
+            return state
+        if state is None:
+            return value
+        if self.func == "sum":
+            return state + value
+        if self.func == "min":
+            return value if value < state else state
+        return value if value > state else state
+
+    def result(self, state):
+        if self.func == "avg":
+            return None if state[1] == 0 else state[0] / state[1]
+        return state
+
+# Resolve group by columns, aggregate functions of the select list and the having clause
+# Aggregated rows are laid out as group by column values followed by aggregate values
+# Returns (group column indexes, aggregates, having test, outputs, sort order) where outputs are
+# (position in aggregated row, kind, column name, table name, table alias) in select order
+def plan_aggregation(joined_cols, select_list, group_by_clause, having_clause, order_by_clause):
+    group_idx = []
+    if group_by_clause is not None:
+        for group_column in group_by_clause.children[2:]:
+            idx = resolve_operand(joined_cols, group_column.children[0], group_column.children[1])
+            if idx not in group_idx:
+                group_idx.append(idx)
+
+    aggregates = []
+    aggregate_keys = []
+    def add_aggregate(func_tree):
+        key = aggregate_key(func_tree)
+        if key in aggregate_keys:
+            return len(group_idx) + aggregate_keys.index(key)
+        func = func_tree.children[0].value.lower()
+        argument = func_tree.children[2]
+        idx = None
+        kind = "int"
+        if len(argument.children) > 0:
+            idx = resolve_operand(joined_cols, argument.children[0], argument.children[1])
+            kind = joined_cols[idx][4]
+        elif func != "count":
+            raise Exception("AggregateTypeError", func)
+        if func in ("sum", "avg") and kind != "int":
+            raise Exception("AggregateTypeError", func)
+        aggregates.append(Aggregate(func, idx, kind))
+        aggregate_keys.append(key)
+        return len(group_idx) + len(aggregates) - 1
+
+    outputs = []
+    if len(select_list.children) == 0:
+        selected = [("column", i) for i in range(len(joined_cols))]
     else:
-        # no table name
-        if operand_tree.children[0] is None:
-            col_name = operand_tree.children[1].children[0].value.lower()
-            if col_name not in [column[2] for column in cols]:
-                raise Exception("WhereColumnNotExist")
-            for i in range(len(cols)):
-                if cols[i][2] == col_name:
-                    return vals[i]
-
-        # with table name
+        selected = []
+        for item in select_list.children:
+            if item.data == "aggregate_column":
+                selected.append(("aggregate", item))
+            else:
+                selected.append(("column", resolve_operand(joined_cols, item.children[0], item.children[1])))
+    for item_type, item in selected:
+        if item_type == "aggregate":
+            pos = add_aggregate(item.children[0])
+            name = aggregate_key(item.children[0]) if item.children[2] is None else item.children[2].children[0].value.lower()
+            outputs.append((pos, aggregates[pos - len(group_idx)].kind, name, None, None))
         else:
-            table_name = operand_tree.children[0].children[0].value.lower()
-            col_name = operand_tree.children[1].children[0].value.lower()
-            for i in range(len(cols)):
-                if cols[i][0] == table_name and cols[i][2] == col_name:
-                    return vals[i]
-                elif cols[i][1] == table_name and cols[i][2] == col_name:
-                    return vals[i]
-
-            if col_name in [column[2] for column in cols]:
-                raise Exception("WhereTableNotSpecified")
+            col = joined_cols[item]
+            if item not in group_idx:
+                raise Exception("GroupByColumnError", col[2])
+            outputs.append((group_idx.index(item), col[4], col[2] if col[3] is None else col[3], col[0], col[1]))
+
+    having_test = None
+    if having_clause is not None:
+        for node in having_clause.iter_subtrees_topdown():
+            if node.data == "aggregate_function":
+                add_aggregate(node)
+        having_cols = [joined_cols[idx] for idx in group_idx]
+        having_cols += [[None, None, key, None, aggregate.kind] for key, aggregate in zip(aggregate_keys, aggregates)]
+        having_test = compile_where(having_cols, having_clause.children[1])
+
+    # aggregated rows are sorted by group by columns, aggregate functions or select aliases
+    order = None
+    if order_by_clause is not None:
+        order = []
+        for sort_key in order_by_clause.children[2:]:
+            target = sort_key.children[0]
+            if len(target.children) == 1:
+                pos = add_aggregate(target.children[0])
             else:
-                raise Exception("WhereColumnNotExist")
-
-def operand_type(operand):
-    # check if operand is int
-    if operand.isdigit():
-        return "int"
-    # check if operand is date
+                pos = None
+                if target.children[0] is None:
+                    name = target.children[1].children[0].value.lower()
+                    for output in outputs:
+                        if output[2] == name:
+                            pos = output[0]
+                if pos is None:
+                    idx = resolve_sort_column(joined_cols, target.children[0], target.children[1])
+                    if idx not in group_idx:
+                        raise Exception("GroupByColumnError", joined_cols[idx][2])
+                    pos = group_idx.index(idx)
+            order.append((pos, sort_key.children[1] is not None and sort_key.children[1].type == "DESC"))
+    return group_idx, aggregates, having_test, outputs, order
+
+# Hash aggregation keeping at most budget groups in memory; rows of the other groups are
+# spilled into partitions by the hash of their group, each partition is aggregated afterwards
+def aggregate_rows(rows, group_idx, aggregates, budget=None, depth=0):
+    budget = AGGREGATE_GROUPS if budget is None else budget
+    groups = {}
+    partitions = None
+    for row in rows:
+        key = tuple(row[i] for i in group_idx)
+        states = groups.get(key)
+        if states is None:
+            if len(groups) >= budget:
+                if partitions is None:
+                    partitions = [RowBuffer(0) for i in range(AGGREGATE_PARTITIONS)]
+                partitions[hash((depth, key)) % AGGREGATE_PARTITIONS].append(row)
+                continue
+            states = [aggregate.initial() for aggregate in aggregates]
+            groups[key] = states
+        for i in range(len(aggregates)):
+            states[i] = aggregates[i].update(states[i], row)
+    # aggregate functions without group by give one row even for no input row
+    if len(groups) == 0 and len(group_idx) == 0 and depth == 0:
+        groups[()] = [aggregate.initial() for aggregate in aggregates]
+    for key, states in groups.items():
+        yield list(key) + [aggregate.result(state) for aggregate, state in zip(aggregates, states)]
+    groups = None
+    if partitions is not None:
+        for partition in partitions:
+            yield from aggregate_rows(partition, group_idx, aggregates, budget, depth + 1)
+            partition.close()
+
+# Helper functions for order by
+def resolve_sort_column(cols, table_tree, column_tree):
     try:
-        datetime.datetime.strptime(operand, '%Y-%m-%d')
-        return "date"
-    except ValueError:
-        pass
-    return "str"
+        return resolve_operand(cols, table_tree, column_tree)
+    except Exception:
+        raise Exception("OrderByColumnError", column_tree.children[0].value.lower())
+
+# Returns the sort order as a list of (row index, descending)
+# A column alias of the select list can be used in place of the column
+def plan_sort(joined_cols, order_by_clause):
+    order = []
+    for sort_key in order_by_clause.children[2:]:
+        target = sort_key.children[0]
+        idx = None
+        if target.children[0] is None:
+            col_alias = target.children[1].children[0].value.lower()
+            for i in range(len(joined_cols)):
+                if joined_cols[i][3] == col_alias:
+                    idx = i
+        if idx is None:
+            idx = resolve_sort_column(joined_cols, target.children[0], target.children[1])
+        order.append((idx, sort_key.children[1] is not None and sort_key.children[1].type == "DESC"))
+    return order
+
+# Sort key component in reverse order, for DESC
+class Descending():
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+# Null sorts after every value, so it comes last in ascending and first in descending order
+def make_sort_key(order):
+    def key(row):
+        parts = []
+        for idx, descending in order:
+            value = row[idx]
+            part = (value is None, value)
+            parts.append(Descending(part) if descending else part)
+        return parts
+    return key
+
+# Sort rows by order; with top only the first top rows are kept in a heap, otherwise rows
+# are sorted in memory up to SORT_BUFFER_ROWS and longer inputs are written as sorted runs
+# to temporary files which are merged
+def sort_rows(rows, order, top=None):
+    key = make_sort_key(order)
+    if top is not None:
+        yield from heapq.nsmallest(top, rows, key=key)
+        return
+    runs = []
+    temporary = []
+    try:
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= SORT_BUFFER_ROWS:
+                runs.append(write_sorted_run(sorted(buffer, key=key), temporary))
+                buffer = []
+        buffer.sort(key=key)
+        if len(runs) == 0:
+            yield from buffer
+            return
+        if len(buffer) > 0:
+            runs.append(write_sorted_run(buffer, temporary))
+        buffer = None
+        # neighbouring runs are merged together so rows with equal keys keep their order
+        while len(runs) > SORT_MERGE_WAYS:
+            merged = []
+            for i in range(0, len(runs), SORT_MERGE_WAYS):
+                merged.append(write_sorted_run(heapq.merge(*runs[i:i + SORT_MERGE_WAYS], key=key), temporary))
+            for run in runs:
+                run.close()
+            runs = merged
+        yield from heapq.merge(*runs, key=key)
+    finally:
+        for run in temporary:
+            run.close()
+
+def write_sorted_run(rows, temporary):
+    run = RowBuffer(0)
+    temporary.append(run)
+    for row in rows:
+        run.append(row)
+    return run
+
+# Skip offset rows and stop after limit rows, closing the input so that no more rows are read
+def limit_rows(rows, limit, offset):
+    try:
+        produced = 0
+        if limit == 0:
+            return
+        for row in rows:
+            if offset > 0:
+                offset -= 1
+                continue
+            yield row
+            produced += 1
+            if produced == limit:
+                return
+    finally:
+        rows.close()
+
+# Helper functions for compiling where clause
+# A where clause is compiled once per statement into a function testing a row; column
+# references and operand types are resolved here, so errors are raised before any row is read
+COMPARE_OPS = {
+    "=": operator.eq,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "!=": operator.ne
+}
+
+def compile_where(cols, expr_tree):
+    return compile_bool_expr(cols, expr_tree)
+
+def compile_bool_expr(cols, expr_tree):
+    terms = [compile_bool_term(cols, term_tree) for term_tree in expr_tree.children[0::2]]
+    if len(terms) == 1:
+        return terms[0]
+    return lambda row: any(term(row) for term in terms)
+
+def compile_bool_term(cols, term_tree):
+    factors = [compile_bool_factor(cols, factor_tree) for factor_tree in term_tree.children[0::2]]
+    if len(factors) == 1:
+        return factors[0]
+    return lambda row: all(factor(row) for factor in factors)
+
+def compile_bool_factor(cols, factor_tree):
+    test = compile_bool_test(cols, factor_tree.children[1])
+    if factor_tree.children[0] is None:
+        return test
+    return lambda row: not test(row)
 
-def test_comparison_predicate(cols, vals, comp_tree):
-    operand1 = parse_operand(cols, vals, comp_tree.children[0])
-    operand2 = parse_operand(cols, vals, comp_tree.children[2])
-    if operand_type(operand1) != operand_type(operand2):
-        raise Exception("WhereIncomparableError")
-    
-    operator = comp_tree.children[1].value
-    if operator == "=":
-        return operand1 == operand2
-    elif operator == ">":
-        return operand1 > operand2
-    elif operator == ">=":
-        return operand1 >= operand2
-    elif operator == "<":
-        return operand1 < operand2
-    elif operator == "<=":
-        return operand1 <= operand2
-    elif operator == "!=":
-        return operand1 != operand2
-
-def test_null_predicate(cols, vals, null_tree):
-    table_name = ""
-    if null_tree.children[0] is not None:
-        table_name = null_tree.children[0].children[0].value.lower()
-    col_name = null_tree.children[1].children[0].value.lower()
-    if col_name not in [column[2] for column in cols]:
+def compile_bool_test(cols, test_tree):
+    node = test_tree.children[0]
+    if node.data == "parenthesized_boolean_expr":
+        return compile_bool_expr(cols, node.children[1])
+    return compile_predicate(cols, node)
+
+def compile_predicate(cols, pred_tree):
+    node = pred_tree.children[0]
+    if node.data == "comparison_predicate":
+        return compile_comparison_predicate(cols, node)
+    else:
+        return compile_null_predicate(cols, node)
+
+# Find the position of a column reference in cols
+def resolve_operand(cols, table_tree, column_tree):
+    col_name = column_tree.children[0].value.lower()
+    # no table name
+    if table_tree is None:
+        matched = [i for i in range(len(cols)) if cols[i][2] == col_name]
+        if len(matched) == 0:
+            raise Exception("WhereColumnNotExist")
+        if len(set((cols[i][0], cols[i][1]) for i in matched)) > 1:
+            raise Exception("WhereAmbiguousReference")
+        return matched[0]
+
+    # with table name
+    table_name = table_tree.children[0].value.lower()
+    for i in range(len(cols)):
+        if (cols[i][0] == table_name or cols[i][1] == table_name) and cols[i][2] == col_name:
+            return i
+    if col_name in [column[2] for column in cols]:
+        raise Exception("WhereTableNotSpecified")
+    else:
         raise Exception("WhereColumnNotExist")
-    
-    value = None
-    if table_name == "":
-        for i in range(len(cols)):
-            if cols[i][2] == col_name:
-                value = vals[i]
+
+# Returns (kind, column index, None) for a column and (kind, None, value) for a constant
+# Constants are converted into the stored form of their kind, so rows are compared natively
+def compile_operand(cols, operand_tree):
+    if len(operand_tree.children) == 1 and operand_tree.children[0].data == "aggregate_function":
+        idx = resolve_aggregate(cols, operand_tree.children[0])
+        return cols[idx][4], idx, None
+    if len(operand_tree.children) == 1:
+        token = operand_tree.children[0].children[0]
+        kind = "char" if token.type == "STR" else token.type.lower()
+        value = literal_value(kind, token)
+        if value is None:
+            raise Exception("WhereIncomparableError")
+        return kind, None, value
+    idx = resolve_operand(cols, operand_tree.children[0], operand_tree.children[1])
+    return cols[idx][4], idx, None
+
+def compile_comparison_predicate(cols, comp_tree):
+    kind1, idx1, value1 = compile_operand(cols, comp_tree.children[0])
+    kind2, idx2, value2 = compile_operand(cols, comp_tree.children[2])
+    if kind1 != kind2:
+        raise Exception("WhereIncomparableError")
+    op = COMPARE_OPS[comp_tree.children[1].value]
+
+    # a comparison with null is never true
+    if idx1 is not None and idx2 is not None:
+        def compare(row):
+            operand1 = row[idx1]
+            operand2 = row[idx2]
+            if operand1 is None or operand2 is None:
+                return False
+            return op(operand1, operand2)
+    elif idx1 is not None:
+        def compare(row):
+            operand1 = row[idx1]
+            if operand1 is None:
+                return False
+            return op(operand1, value2)
+    elif idx2 is not None:
+        def compare(row):
+            operand2 = row[idx2]
+            if operand2 is None:
+                return False
+            return op(value1, operand2)
     else:
-        for i in range(len(cols)):
-            if cols[i][0] == table_name and cols[i][2] == col_name:
-                value = vals[i]
-            elif cols[i][1] == table_name and cols[i][2] == col_name:
-                value = vals[i]
+        result = op(value1, value2)
+        def compare(row):
+            return result
+    return compare
+
+def compile_null_predicate(cols, null_tree):
+    idx = resolve_operand(cols, null_tree.children[0], null_tree.children[1])
     null_operation = null_tree.children[2]
     if null_operation.children[1] is None:
-        return value == "null"
+        return lambda row: row[idx] is None
     else:
-        return value != "null"
+        return lambda row: row[idx] is not None
+
+# Find the position of an aggregate function in cols, where it is named by aggregate_key()
+# Only the columns of a having clause contain aggregate functions
+def resolve_aggregate(cols, func_tree):
+    key = aggregate_key(func_tree)
+    for i in range(len(cols)):
+        if cols[i][0] is None and cols[i][2] == key:
+            return i
+    raise Exception("WhereAggregateError")
+
 # 쿼리 규칙
 # 1. 쿼리는 항상 ;(세미콜론)으로 끝난다.
 # 2. ;(세미콜론)이 나오기 전까지 개행문자를 받아도 쿼리를 끝내지 않는다. (대신 PROMPT는 출력되지 않음)
 # 3. 한 줄에 여러 쿼리가 ;(세미콜론)으로 구분되어 들어오면, 처음부터 순차적으로 처리한다.
 # 4. 쿼리에 오류가 없는 경우 (해당 쿼리) requestd를 출력하고, 에러가 발생한 경우 Syntax error를 출력한다.
 def main():
+    open_environment()
+    transactions.begin_statement()
     if os.path.exists("./DB/catalog.db"):
-        catalogDB.open("./DB/catalog.db", dbtype=db.DB_HASH)
+        catalogDB.open("catalog.db", dbtype=db.DB_HASH, flags=db.DB_AUTO_COMMIT)
+        # tables written by an older version must be converted by migrate.py
+        if catalogDB.get(b"row_format", txn=transactions.txn) != ROW_FORMAT:
+            if len(pickle.loads(catalogDB.get(b"tables", txn=transactions.txn))) > 0:
+                print(MY_PROMPT + "Tables are stored in an old row format, run migrate.py first")
+                transactions.abort_statement()
+                close_environment()
+                return
+            catalogDB.put(b"row_format", ROW_FORMAT, txn=transactions.txn)
+        # build the foreign key indexes of tables created before they existed
+        if catalogDB.get(b"fk_indexes", txn=transactions.txn) is None:
+            for table_name in schema_cache.table_names():
+                schema = schema_cache.get(table_name)
+                for fk_index in schema.fk_indexes.values():
+                    build_index(schema, fk_index)
+            catalogDB.put(b"fk_indexes", b"1", txn=transactions.txn)
     else:
-        catalogDB.open("./DB/catalog.db", dbtype=db.DB_HASH, flags=db.DB_CREATE)
-        catalogDB.put(b"tables", pickle.dumps(list()))
+        catalogDB.open("catalog.db", dbtype=db.DB_HASH, flags=db.DB_CREATE | db.DB_AUTO_COMMIT)
+        catalogDB.put(b"tables", pickle.dumps(list()), txn=transactions.txn)
+        catalogDB.put(b"row_format", ROW_FORMAT, txn=transactions.txn)
+        catalogDB.put(b"fk_indexes", b"1", txn=transactions.txn)
+    transactions.end_statement()
 
     with open("grammar.lark") as file:
         sql_parser = Lark(file.read(), start="command", parser="lalr", transformer=T())
@@ -878,13 +2840,26 @@ def main():
 
         queries = [query.strip() + ";" for query in text.split(";") if query]
         for query in queries:
+            # a failed statement is rolled back once its exception, and the cursors referenced
+            # by its traceback, are released
+            failed = True
+            transactions.begin_statement()
             try:
                 sql_parser.parse(query)
+                failed = False
             except exceptions.UnexpectedToken or exceptions.UnexpectedCharacters or exceptions.UnexpectedInput:
                 print(MY_PROMPT + "Syntax error")
                 break
+            # errors of the storage engine carry (error number, message)
+            except db.DBError as e:
+                message = e.args[1] if len(e.args) > 1 else str(e)
+                print(MY_PROMPT + "Statement has failed: " + str(message))
+                break
             except Exception as e:
-                err = e.args[0]
+                err = e.args[0] if len(e.args) > 0 else None
+                if not isinstance(err, str):
+                    print(e)
+                    break
                 if err == "DuplicateColumnDefError":
                     print(MY_PROMPT + "Create table has failed: column definition is duplicated")
                 elif err == "DuplicatePrimaryKeyDefError":
@@ -901,7 +2876,9 @@ def main():
                     print(MY_PROMPT + "Create table has failed: '" + e.args[1] + "' does not exist in column definition")
                 elif err == "TableExistenceError":
                     print(MY_PROMPT + "Create table has failed: table with the same name already exists")
-                elif err == "WhrerColumnNotExist":
+                elif err == "PageSizeError":
+                    print(MY_PROMPT + "Create table has failed: page size must be a power of two from " + str(MIN_PAGE_SIZE) + " to " + str(MAX_PAGE_SIZE))
+                elif err == "WhereColumnNotExist":
                     print(MY_PROMPT + "Where clause try to reference non existing column")
                 elif err == "WhereTableNotSpecified":
                     print(MY_PROMPT + "Where clause try to reference tables which are not specified")
@@ -909,12 +2886,33 @@ def main():
                     print(MY_PROMPT + "Where clause try to compare incomparable values")
                 elif err == "WhereAmbiguousReference":
                     print(MY_PROMPT + "Where clause contains ambiguous reference")
+                elif err == "WhereAggregateError":
+                    print(MY_PROMPT + "Where clause can not use aggregate functions")
+                elif err == "GroupByColumnError":
+                    print(MY_PROMPT + "Select has failed: '" + e.args[1] + "' must appear in group by clause")
+                elif err == "SelectColumnResolveError":
+                    print(MY_PROMPT + "Selection has failed: fail to resolve '" + e.args[1] + "'")
+                elif err == "OrderByColumnError":
+                    print(MY_PROMPT + "Select has failed: cannot order by '" + e.args[1] + "'")
+                elif err == "AggregateTypeError":
+                    print(MY_PROMPT + "Select has failed: " + e.args[1] + " needs an int column")
                 else:
                     print(e)
                 break
             except SystemExit:
-                catalogDB.close()
+                transactions.abort_statement()
+                close_environment()
                 exit()
+            finally:
+                if failed:
+                    transactions.abort_statement()
+                else:
+                    transactions.end_statement()
+        # keep the number of open table files under MAX_OPEN_TABLES, handles used by an
+        # unfinished transaction stay open
+        if transactions.user_txn is None:
+            table_pool.release()
+        bloom_filters.save_all()
 
 
 if __name__ == "__main__":